@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+MDRRMO Procurement System API load benchmark
+Seeds a database with purchases and audit trails, drives the FastAPI app in-process
+with httpx at several concurrency levels and reports latency percentiles and
+throughput per route as JSON that can be compared between versions.
+
+Runs against a local MongoDB when --mongo-url (or MONGO_URL) is given, using a
+throwaway database, and against an in-memory mongomock-motor database otherwise.
+mongomock is much slower than MongoDB, so its numbers are only comparable with
+other mongomock runs.
+
+Usage:
+  python api_benchmark.py --purchases 5000 --concurrency 1,8,32 --output before.json
+  python api_benchmark.py --purchases 5000 --concurrency 1,8,32 --baseline before.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+ROUTES = ["list", "get", "create", "status", "stats", "upload"]
+STATUSES = ["Pending", "For Review", "Approved", "Denied", "Completed"]
+PRIORITIES = ["Low", "Normal", "High", "Urgent"]
+DEPARTMENTS = ["MDRRMO", "MHO", "MSWDO", "MEO", "Mayor's Office", "Treasury"]
+ITEM_NAMES = [
+    "Rice (25kg sack)", "Bottled water (case)", "Canned goods (box)", "Hygiene kit",
+    "Folding bed", "Tarpaulin", "Flashlight", "First aid kit", "Life vest", "Generator fuel",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL"), help="Local MongoDB to benchmark against")
+    parser.add_argument("--purchases", type=int, default=2000, help="Purchases to seed")
+    parser.add_argument("--audit-entries", type=int, default=4, help="Audit entries seeded per purchase")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route and concurrency level")
+    parser.add_argument("--routes", default=",".join(ROUTES), help=f"Routes to run ({', '.join(ROUTES)})")
+    parser.add_argument("--upload-size", type=int, default=256, help="Attachment size in KiB for the upload route")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for generated data and requests")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against results previously written with --output")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark database on a real MongoDB")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# The database and upload directory must be settled before server.py is imported
+DB_NAME = f"mdrrmo_benchmark_{uuid.uuid4().hex[:8]}"
+os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+os.environ["DB_NAME"] = DB_NAME
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import httpx
+
+import server
+
+logging.getLogger().setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+if not args.mongo_url:
+    from mongomock_motor import AsyncMongoMockClient
+    server.client = AsyncMongoMockClient()
+    server.db = server.client[DB_NAME]
+
+# Keep benchmark attachments out of the real uploads directory
+UPLOADS = Path(tempfile.mkdtemp(prefix="mdrrmo-benchmark-"))
+server.UPLOADS_DIR = UPLOADS
+server.INCOMING_DIR = UPLOADS / ".incoming"
+server.BLOBS_DIR = UPLOADS / "blobs"
+server.INCOMING_DIR.mkdir()
+server.BLOBS_DIR.mkdir()
+
+
+def make_purchase(rng, index, year):
+    created = server.utc_now() - timedelta(minutes=index * 7)
+    items = []
+    for number in range(1, rng.randint(3, 8) + 1):
+        quantity = rng.randint(1, 200)
+        unit_price = round(rng.uniform(15, 5000), 2)
+        items.append({
+            "number": number,
+            "name": rng.choice(ITEM_NAMES),
+            "description": "For disaster response and evacuation center operations",
+            "unit": rng.choice(["pc", "box", "pack", "set"]),
+            "quantity": quantity,
+            "unitPrice": unit_price,
+            "total": round(quantity * unit_price, 2),
+        })
+    number = index + 1
+    return server.price_purchase({
+        "id": str(uuid.uuid4()),
+        "prNo": server.generate_id("PR", year, number),
+        "poNo": server.generate_id("PO", year, number),
+        "obrNo": server.generate_id("OBR", year, number),
+        "dvNo": server.generate_id("DV", year, number),
+        "title": f"Procurement of {rng.choice(ITEM_NAMES).lower()} #{number}",
+        "date": server.parse_date(created),
+        "department": rng.choice(DEPARTMENTS),
+        "purpose": "Disaster preparedness and response",
+        "status": rng.choice(STATUSES),
+        "priority": rng.choice(PRIORITIES),
+        "supplier1": {"name": "ABC Trading", "address": "Poblacion"},
+        "supplier2": {"name": "XYZ Supply", "address": "Municipal Hall Road"},
+        "supplier3": {"name": "", "address": ""},
+        "items": items,
+        "approvalInfo": {"approvedBy": "", "approvedAt": None, "comments": "", "signature": ""},
+        "attachments": [],
+        "createdAt": created,
+        "updatedAt": None,
+        "createdBy": "Benchmark",
+    })
+
+
+def make_audit_trail(rng, purchase, count):
+    created = purchase["createdAt"]
+    entries = [server.create_audit_entry("created", "Benchmark", f"Purchase request '{purchase['title']}' created")]
+    entries[0]["timestamp"] = created
+    for step in range(1, count):
+        entry = server.create_audit_entry(
+            rng.choice(["updated", "status_changed", "attachment_added"]), "Benchmark", "Seeded history entry"
+        )
+        entry["timestamp"] = created + timedelta(minutes=step)
+        entries.append(entry)
+    return [server.audit_document(purchase["id"], entry) for entry in entries]
+
+
+async def insert_seed_batch(purchases, audit):
+    # insert_many adds _id to the dicts it is given
+    await server.db.purchases.insert_many([dict(p) for p in purchases])
+    await server.db.purchase_audit.insert_many(audit)
+    # Same incremental counter path as the write routes, so no aggregation rebuild is needed
+    await server.apply_stats_changes([(None, p) for p in purchases])
+
+
+async def seed(rng):
+    year = datetime.now().year
+    ids = []
+    batch, audit = [], []
+    for index in range(args.purchases):
+        purchase = make_purchase(rng, index, year)
+        ids.append(purchase["id"])
+        batch.append(purchase)
+        audit.extend(make_audit_trail(rng, purchase, args.audit_entries))
+        if len(batch) >= 1000:
+            await insert_seed_batch(batch, audit)
+            batch, audit = [], []
+    if batch:
+        await insert_seed_batch(batch, audit)
+    for prefix in server.SEQUENCE_FIELDS:
+        await server.document_sequences.advance_past(prefix, year, args.purchases)
+    await server.purchases_changed()
+    return ids
+
+
+def purchase_payload(rng):
+    quantity = rng.randint(1, 50)
+    unit_price = round(rng.uniform(15, 5000), 2)
+    return {
+        "title": f"Benchmark purchase {uuid.uuid4().hex[:6]}",
+        "date": datetime.now().date().isoformat(),
+        "department": rng.choice(DEPARTMENTS),
+        "priority": rng.choice(PRIORITIES),
+        "supplier1": {"name": "ABC Trading", "address": "Poblacion"},
+        "items": [{
+            "number": 1, "name": rng.choice(ITEM_NAMES), "unit": "pc",
+            "quantity": quantity, "unitPrice": unit_price, "total": round(quantity * unit_price, 2),
+        }],
+        "totalAmount": round(quantity * unit_price, 2),
+        "createdBy": "Benchmark",
+    }
+
+
+def request_factory(route, rng, ids, upload_body):
+    """Returns a coroutine function issuing one request of the given route"""
+    list_filters = [{}, {"status": "Pending"}, {"department": "MDRRMO"}, {"priority": "High", "limit": 100}]
+
+    async def send(client):
+        if route == "list":
+            return await client.get("/api/purchases", params=rng.choice(list_filters))
+        if route == "get":
+            return await client.get(f"/api/purchases/{rng.choice(ids)}")
+        if route == "create":
+            return await client.post("/api/purchases", json=purchase_payload(rng))
+        if route == "status":
+            return await client.patch(
+                f"/api/purchases/{rng.choice(ids)}/status",
+                json={"status": rng.choice(STATUSES), "approvedBy": "Benchmark"},
+            )
+        if route == "stats":
+            return await client.get("/api/purchases/stats/dashboard")
+        if route == "upload":
+            # Distinct content per request so every upload stores a new blob
+            body = upload_body + uuid.uuid4().bytes
+            return await client.post(
+                f"/api/purchases/{rng.choice(ids)}/attachments",
+                files={"file": ("quotation.pdf", body, "application/pdf")},
+                data={"uploaded_by": "Benchmark"},
+            )
+        raise ValueError(f"Unknown route: {route}")
+
+    return send
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return None
+    rank = max(1, round(fraction * len(sorted_values) + 0.5))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+async def run_scenario(client, route, concurrency, send):
+    latencies = []
+    errors = 0
+    remaining = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                response = await send(client)
+                if response.status_code >= 400:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "route": route,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "p50Ms": round(percentile(latencies, 0.50), 2),
+        "p95Ms": round(percentile(latencies, 0.95), 2),
+        "p99Ms": round(percentile(latencies, 0.99), 2),
+        "meanMs": round(sum(latencies) / len(latencies), 2),
+        "throughputRps": round(len(latencies) / elapsed, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=Path(__file__).parent, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_results(results, baseline):
+    previous = {(r["route"], r["concurrency"]): r for r in (baseline or {}).get("results", [])}
+    header = f"{'route':<8} {'conc':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'errors':>6}"
+    if previous:
+        header += f" {'p95 vs base':>12} {'req/s vs base':>14}"
+    print(header)
+    for r in results:
+        line = (
+            f"{r['route']:<8} {r['concurrency']:>4} {r['p50Ms']:>9} {r['p95Ms']:>9} "
+            f"{r['p99Ms']:>9} {r['throughputRps']:>9} {r['errors']:>6}"
+        )
+        before = previous.get((r["route"], r["concurrency"]))
+        if before:
+            p95_change = (r["p95Ms"] - before["p95Ms"]) / before["p95Ms"] * 100 if before["p95Ms"] else 0
+            rps_change = (r["throughputRps"] - before["throughputRps"]) / before["throughputRps"] * 100 if before["throughputRps"] else 0
+            line += f" {p95_change:>+11.1f}% {rps_change:>+13.1f}%"
+        print(line)
+
+
+async def main():
+    rng = random.Random(args.seed)
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        sys.exit(f"Unknown routes: {', '.join(unknown)}")
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    upload_body = rng.randbytes(args.upload_size * 1024)
+
+    try:
+        # Seed before the startup hooks so they find the dashboard counters already built
+        await server.ensure_indexes()
+        seed_started = time.perf_counter()
+        ids = await seed(rng)
+        print(f"Seeded {args.purchases} purchases in {time.perf_counter() - seed_started:.1f}s "
+              f"({'MongoDB' if args.mongo_url else 'mongomock'})")
+        await server.app.router.startup()
+
+        results = []
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            for route in routes:
+                for concurrency in levels:
+                    send = request_factory(route, rng, ids, upload_body)
+                    results.append(await run_scenario(client, route, concurrency, send))
+    finally:
+        if args.mongo_url and not args.keep:
+            await server.client.drop_database(DB_NAME)
+        await server.app.router.shutdown()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "startedAt": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "database": "mongodb" if args.mongo_url else "mongomock",
+            "purchases": args.purchases,
+            "auditEntriesPerPurchase": args.audit_entries,
+            "requestsPerScenario": args.requests,
+            "uploadSizeKiB": args.upload_size,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,33 +1,329 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Query
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Query, Request
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, UpdateOne, ReturnDocument, ASCENDING, DESCENDING, TEXT, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import json_util
+from python_multipart import MultipartParser
+from python_multipart.multipart import parse_options_header
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, field_validator
+from pydantic import BaseModel, Field, ConfigDict, ValidationError, field_validator
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from email.utils import formatdate
+from urllib.parse import quote
+import anyio
+import asyncio
 import base64
+import bisect
+import codecs
+import collections
+import csv
+import hashlib
+import io
 import json
+import random
+import re
+import tempfile
+import threading
+import time
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Request and MongoDB command metrics served on /metrics
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() not in ('false', '0', 'no')
+
+# Opt-in slow query profiler: reads slower than the threshold are recorded with
+# their explain() plan in a capped collection, see /api/admin/slow-queries
+SLOW_QUERY_PROFILER = os.environ.get('SLOW_QUERY_PROFILER', 'false').lower() in ('true', '1', 'yes')
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', '100'))
+# Each query shape is explained at most once per interval; explain re-runs the query
+SLOW_QUERY_EXPLAIN_INTERVAL = 5 * 60
+SLOW_QUERY_LOG_BYTES = 16 * 1024 * 1024
+
+
+# ==================== Metrics ====================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MONGO_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+DOCUMENT_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+def _label_text(names: tuple, values: tuple) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return ",".join(pairs)
+
+class Counter:
+    """Monotonic counter per label set, rendered in the Prometheus text format"""
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        # pymongo reports command events from its own threads
+        self.lock = threading.Lock()
+    
+    def inc(self, label_values: tuple = (), amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [
+            f"{self.name}{{{_label_text(self.labels, labels)}}} {value}" if self.labels else f"{self.name} {value}"
+            for labels, value in values
+        ]
+
+class Gauge(Counter):
+    kind = "gauge"
+    
+    def dec(self, label_values: tuple = (), amount: float = 1):
+        self.inc(label_values, -amount)
+
+class Histogram:
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: a count for each bucket plus +Inf, then the sum
+        self.series: Dict[tuple, list] = {}
+        self.lock = threading.Lock()
+    
+    def observe(self, label_values: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    def samples(self) -> List[str]:
+        with self.lock:
+            series = [(labels, list(values)) for labels, values in self.series.items()]
+        lines = []
+        for labels, values in series:
+            label_text = _label_text(self.labels, labels)
+            prefix = f"{label_text}," if label_text else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{label_text}}} {cumulative}")
+        return lines
+
+http_requests_total = Counter("http_requests_total", "HTTP requests by route and status code", ("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route"), LATENCY_BUCKETS)
+http_requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being handled")
+mongodb_commands_total = Counter("mongodb_commands_total", "MongoDB commands by collection and outcome", ("command", "collection", "outcome"))
+mongodb_command_duration = Histogram("mongodb_command_duration_seconds", "MongoDB command latency by collection", ("command", "collection"), MONGO_LATENCY_BUCKETS)
+mongodb_documents_returned = Histogram(
+    "mongodb_command_documents_returned",
+    "Documents per find/aggregate/getMore reply by collection",
+    ("command", "collection"),
+    DOCUMENT_BUCKETS
+)
+
+METRICS = [
+    http_requests_total, http_request_duration, http_requests_in_flight,
+    mongodb_commands_total, mongodb_command_duration, mongodb_documents_returned,
+]
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Counts, durations and returned documents for every command the driver sends"""
+    def __init__(self):
+        self.collections: Dict[tuple, str] = {}
+    
+    def started(self, event):
+        command = event.command
+        target = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+        self.collections[(event.connection_id, event.request_id)] = target if isinstance(target, str) else ""
+    
+    def succeeded(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        labels = (event.command_name, collection)
+        mongodb_commands_total.inc((event.command_name, collection, "success"))
+        mongodb_command_duration.observe(labels, event.duration_micros / 1_000_000)
+        cursor = event.reply.get("cursor")
+        if isinstance(cursor, dict):
+            batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+            if batch is not None:
+                mongodb_documents_returned.observe(labels, len(batch))
+    
+    def failed(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        mongodb_commands_total.inc((event.command_name, collection, "failure"))
+        mongodb_command_duration.observe((event.command_name, collection), event.duration_micros / 1_000_000)
+
+class MetricsMiddleware:
+    """
+    Per-route request counts, latency and in-flight requests. Plain ASGI rather than
+    BaseHTTPMiddleware so streaming responses pass through untouched; the route is
+    labelled by its path template so ids don't create a series each.
+    """
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status = 500
+        
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        http_requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_requests_in_flight.dec()
+            # The router stores the matched route in the shared scope
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            http_request_duration.observe((scope["method"], route), elapsed)
+            http_requests_total.inc((scope["method"], route, str(status)))
+
+SLOW_QUERY_COMMANDS = ("find", "aggregate", "count", "distinct")
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Hands read commands slower than SLOW_QUERY_THRESHOLD_MS to record_slow_query on the event loop"""
+    def __init__(self):
+        self.commands: Dict[tuple, tuple] = {}
+        # Set at startup; events arrive on the driver's threads
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def started(self, event):
+        if event.command_name in SLOW_QUERY_COMMANDS:
+            self.commands[(event.connection_id, event.request_id)] = (event.database_name, event.command)
+    
+    def succeeded(self, event):
+        started = self.commands.pop((event.connection_id, event.request_id), None)
+        if started and self.loop and event.duration_micros >= SLOW_QUERY_THRESHOLD_MS * 1000:
+            database, command = started
+            self.loop.call_soon_threadsafe(
+                schedule_slow_query, database, event.command_name, command, event.duration_micros / 1000
+            )
+    
+    def failed(self, event):
+        self.commands.pop((event.connection_id, event.request_id), None)
+
+slow_query_listener = SlowQueryListener()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    event_listeners=([MongoCommandMetrics()] if METRICS_ENABLED else [])
+        + ([slow_query_listener] if SLOW_QUERY_PROFILER else [])
+)
 db = client[os.environ['DB_NAME']]
 
 # Create uploads directory
 UPLOADS_DIR = ROOT_DIR / 'uploads'
 UPLOADS_DIR.mkdir(exist_ok=True)
 
+# Partial uploads live next to the final files so the last step is an atomic rename
+INCOMING_DIR = UPLOADS_DIR / '.incoming'
+INCOMING_DIR.mkdir(exist_ok=True)
+
+# Attachment size limits; resumable uploads are meant for large scanned documents
+MAX_ATTACHMENT_SIZE = int(os.environ.get('MAX_ATTACHMENT_SIZE', str(10 * 1024 * 1024)))
+MAX_RESUMABLE_ATTACHMENT_SIZE = int(os.environ.get('MAX_RESUMABLE_ATTACHMENT_SIZE', str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SESSION_TTL_HOURS = 24
+
+# Attachments are stored once per distinct content under blobs/<aa>/<bb>/<sha256>
+BLOBS_DIR = UPLOADS_DIR / 'blobs'
+BLOBS_DIR.mkdir(exist_ok=True)
+# Seconds between background sweeps for orphaned attachment files (0 disables)
+ATTACHMENT_COMPACTION_INTERVAL = int(os.environ.get('ATTACHMENT_COMPACTION_INTERVAL', str(6 * 60 * 60)))
+# Files younger than this are never treated as orphans, so in-flight uploads are safe
+ORPHAN_GRACE_SECONDS = 60 * 60
+
+# Pagination settings for list endpoints
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '500'))
+
+# Most purchases a single PATCH /purchases/status:batch may change
+STATUS_BATCH_MAX_IDS = int(os.environ.get('STATUS_BATCH_MAX_IDS', '1000'))
+
+# Document numbers reserved per counter round trip; values above 1 let each
+# worker hand out numbers locally at the cost of gaps when it restarts
+SEQUENCE_BLOCK_SIZE = int(os.environ.get('SEQUENCE_BLOCK_SIZE', '1'))
+
+# Multi-document transactions: "auto" uses them when the server is a replica set
+# or sharded cluster, "true" requires them, "false" never uses them
+MONGO_TRANSACTIONS = os.environ.get('MONGO_TRANSACTIONS', 'auto').lower()
+
+# Bulk import settings
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '1000'))
+IMPORT_CHUNK_SIZE = 64 * 1024
+IMPORT_MAX_REPORTED_ERRORS = 1000
+EXPORT_BATCH_SIZE = 500
+
+# Notification delivery: mutations write to an outbox that a background worker
+# drains into the configured sinks (comma-separated names, see NOTIFICATION_SINK_TYPES)
+NOTIFICATION_SINKS = os.environ.get('NOTIFICATION_SINKS', 'inbox')
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '2'))
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_BACKOFF_SECONDS = 2
+OUTBOX_MAX_BACKOFF_SECONDS = 10 * 60
+OUTBOX_RETENTION_DAYS = 7
+
+# In-app notifications are removed by a TTL index this many days after creation
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', '30'))
+
+# Live event stream (/api/stream): "auto" follows MongoDB change streams when the
+# deployment supports them, "false" publishes from this process's own writes only
+CHANGE_STREAMS = os.environ.get('CHANGE_STREAMS', 'auto').lower()
+STREAM_HISTORY_SIZE = 1000
+STREAM_QUEUE_SIZE = 256
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_RETRY_SECONDS = 5
+
+# Rendered purchase reads are cached per normalized request and revalidated
+# against a collection version that every purchase write replaces (0 disables)
+PURCHASE_CACHE_ENTRIES = int(os.environ.get('PURCHASE_CACHE_ENTRIES', '256'))
+PURCHASE_CACHE_MAX_BYTES = int(os.environ.get('PURCHASE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
 # Create the main app without a prefix
-app = FastAPI(title="MDRRMO Procurement System API")
+# orjson renders responses several times faster than the stdlib json encoder
+app = FastAPI(title="MDRRMO Procurement System API", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -37,8 +333,9 @@ api_router = APIRouter(prefix="/api")
 
 # Audit Trail Entry
 class AuditEntry(BaseModel):
+    id: Optional[str] = None
     timestamp: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
-    action: str  # created, updated, status_changed, approved, denied, attachment_added, attachment_removed
+    action: str  # created, updated, imported, status_changed, approved, denied, attachment_added, attachment_removed
     user: str = "System"
     details: str = ""
     previousValue: Optional[str] = None
@@ -60,6 +357,7 @@ class Attachment(BaseModel):
     size: int
     uploadedAt: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     uploadedBy: str = "System"
+    sha256: Optional[str] = None
 
 # Supplier Model
 class Supplier(BaseModel):
@@ -85,6 +383,7 @@ class Notification(BaseModel):
     purchaseId: Optional[str] = None
     read: bool = False
     createdAt: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    seq: Optional[int] = None  # Delivery order in the inbox; unset until delivered
 
 class NotificationCreate(BaseModel):
     type: str
@@ -92,6 +391,11 @@ class NotificationCreate(BaseModel):
     message: str
     purchaseId: Optional[str] = None
 
+class NotificationPage(BaseModel):
+    items: List[Notification]
+    hasMore: bool
+    nextCursor: Optional[str] = None
+
 # Purchase/Procurement Model
 class Purchase(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -116,8 +420,6 @@ class Purchase(BaseModel):
     approvalInfo: ApprovalInfo = ApprovalInfo()
     # Attachments
     attachments: List[Attachment] = []
-    # Audit trail
-    auditTrail: List[AuditEntry] = []
     createdAt: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     updatedAt: Optional[str] = None
     createdBy: str = "System"
@@ -133,7 +435,8 @@ class PurchaseCreate(BaseModel):
     supplier2: Supplier = Supplier()
     supplier3: Supplier = Supplier()
     items: List[ProcurementItem]
-    totalAmount: float
+    # Accepted for compatibility; the stored total is always recomputed from items
+    totalAmount: Optional[float] = None
     createdBy: str = "System"
     
     @field_validator('title')
@@ -143,6 +446,12 @@ class PurchaseCreate(BaseModel):
             raise ValueError('Title is required')
         return v.strip()
     
+    @field_validator('date')
+    @classmethod
+    def date_is_calendar_date(cls, v):
+        parse_date(v)
+        return v.strip()
+    
     @field_validator('items')
     @classmethod
     def items_not_empty(cls, v):
@@ -168,6 +477,84 @@ class StatusUpdate(BaseModel):
     comments: str = ""
     approvedBy: str = ""
 
+class BatchStatusUpdate(BaseModel):
+    ids: List[str]
+    status: str
+    comments: str = ""
+    approvedBy: str = ""
+    
+    @field_validator('ids')
+    @classmethod
+    def ids_within_limit(cls, v):
+        # Repeated ids would otherwise be audited and notified twice
+        v = list(dict.fromkeys(v))
+        if not v:
+            raise ValueError('At least one id is required')
+        if len(v) > STATUS_BATCH_MAX_IDS:
+            raise ValueError(f'At most {STATUS_BATCH_MAX_IDS} ids can be updated at once')
+        return v
+    
+    @field_validator('status')
+    @classmethod
+    def status_known(cls, v):
+        if v not in STATUS_COUNTERS:
+            raise ValueError(f"Status must be one of: {', '.join(STATUS_COUNTERS)}")
+        return v
+
+class BatchStatusResult(BaseModel):
+    id: str
+    result: str  # updated, unchanged, not_found, conflict
+    previousStatus: Optional[str] = None
+
+class BatchStatusResponse(BaseModel):
+    status: str
+    updated: int
+    results: List[BatchStatusResult]
+
+class PurchasePage(BaseModel):
+    items: List[Dict[str, Any]]
+    # Only counted for the first page; cursor pages return null
+    total: Optional[int] = None
+    hasMore: bool
+    nextCursor: Optional[str] = None
+
+class UploadSession(BaseModel):
+    id: str
+    purchaseId: str
+    originalName: str
+    mimeType: str
+    size: int
+    received: int = 0
+    uploadedBy: str = "System"
+    createdAt: str
+
+class PurchaseHistory(BaseModel):
+    purchaseId: str
+    prNo: Optional[str] = None
+    title: Optional[str] = None
+    history: List[AuditEntry]
+    total: int
+    hasMore: bool
+    nextCursor: Optional[str] = None
+
+class ImportRowError(BaseModel):
+    row: int
+    id: Optional[str] = None
+    errors: List[str]
+
+class ImportReport(BaseModel):
+    processed: int = 0
+    inserted: int = 0
+    updated: int = 0
+    failed: int = 0
+    errors: List[ImportRowError] = []
+    errorsTruncated: bool = False
+
+class StatsBreakdown(BaseModel):
+    key: str
+    count: int
+    totalAmount: float
+
 class DashboardStats(BaseModel):
     total: int
     approved: int
@@ -178,19 +565,192 @@ class DashboardStats(BaseModel):
     totalAmount: float
     highPriority: int
     recentActivity: int
+    byDepartment: List[StatsBreakdown] = []
+    byMonth: List[StatsBreakdown] = []
 
 
 # ==================== Helper Functions ====================
 
-def generate_id(prefix: str, count: int) -> str:
-    """Generate ID with year and count"""
-    year = datetime.now().year
-    return f"{year}-{prefix}-{str(count + 1).zfill(3)}"
+def generate_id(prefix: str, year: int, number: int) -> str:
+    """Format a document number such as 2025-PR-001"""
+    return f"{year}-{prefix}-{str(number).zfill(3)}"
+
+# Purchase dates are stored as BSON datetimes in UTC and rendered as the strings
+# the API has always returned: YYYY-MM-DD for date, ISO 8601 for the timestamps
+PURCHASE_TIMESTAMP_FIELDS = ("createdAt", "updatedAt")
+
+def utc_now() -> datetime:
+    """Current time at the millisecond precision BSON stores, so responses match later reads"""
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def parse_datetime(value) -> Optional[datetime]:
+    """An ISO 8601 timestamp (Z or offset, or none for UTC) as an aware UTC datetime; raises ValueError"""
+    if value is None or value == "":
+        return None
+    parsed = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def parse_date(value) -> Optional[datetime]:
+    """A calendar date, or the date part of a timestamp, as UTC midnight; raises ValueError"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+    return datetime.strptime(str(value).strip()[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+def format_datetime(value):
+    # Values the date migration couldn't parse are still strings
+    if isinstance(value, datetime):
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).isoformat()
+    return value
+
+def format_date(value) -> str:
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    return value or ""
+
+def month_key(value) -> str:
+    """YYYY-MM bucket of a purchase date, matching the byMonth aggregation"""
+    return value.strftime("%Y-%m") if isinstance(value, datetime) else ""
+
+def store_purchase_dates(purchase: dict) -> dict:
+    """Convert the date fields present in a purchase to datetimes for storage"""
+    if "date" in purchase:
+        purchase["date"] = parse_date(purchase["date"])
+    for field in PURCHASE_TIMESTAMP_FIELDS:
+        if purchase.get(field) is not None:
+            purchase[field] = parse_datetime(purchase[field])
+    return purchase
+
+def format_purchase_dates(purchase: dict) -> dict:
+    """Render the stored date fields of a purchase as API strings, in place"""
+    if "date" in purchase:
+        purchase["date"] = format_date(purchase["date"])
+    for field in PURCHASE_TIMESTAMP_FIELDS:
+        if field in purchase:
+            purchase[field] = format_datetime(purchase[field])
+    return purchase
+
+def to_centavos(amount) -> int:
+    """Round a peso amount to whole centavos, half up like a receipt"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_centavos(centavos: Optional[int]) -> float:
+    return (centavos or 0) / 100
+
+def price_purchase(purchase: dict) -> dict:
+    """
+    Normalize item prices to whole centavos and set every line total and the
+    purchase total from them in one pass. totalCentavos is the exact value that
+    filters and stats use; the peso fields are derived from it for the API.
+    """
+    total = 0
+    for item in purchase.get("items") or []:
+        unit_price = to_centavos(item.get("unitPrice") or 0)
+        line_total = int((Decimal(str(item.get("quantity") or 0)) * unit_price).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+        item["unitPrice"] = from_centavos(unit_price)
+        item["total"] = from_centavos(line_total)
+        total += line_total
+    purchase["totalCentavos"] = total
+    purchase["totalAmount"] = from_centavos(total)
+    return purchase
+
+def parse_document_number(value: str) -> Optional[tuple]:
+    """Split a number produced by generate_id into (prefix, year, number)"""
+    parts = (value or "").split("-")
+    if len(parts) != 3 or not parts[0].isdigit() or not parts[2].isdigit():
+        return None
+    return parts[1], int(parts[0]), int(parts[2])
+
+# Purchase field holding each document number series
+SEQUENCE_FIELDS = {"PR": "prNo", "PO": "poNo", "OBR": "obrNo", "DV": "dvNo"}
+
+class SequenceAllocator:
+    """Hands out document numbers from the counters collection, one series per prefix and year"""
+    
+    def __init__(self, block_size: int = 1):
+        self.block_size = max(1, block_size)
+        self._blocks: Dict[str, List[int]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._seeded: set = set()
+    
+    async def next(self, prefix: str, year: int) -> int:
+        key = f"{prefix}-{year}"
+        # Unblocked allocation after seeding needs no local coordination
+        if self.block_size == 1 and key in self._seeded:
+            return await self._reserve(key, prefix, year, 1)
+        
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            block = self._blocks.get(key)
+            if block and block[0] <= block[1]:
+                block[0] += 1
+                return block[0] - 1
+            
+            await self._ensure_seeded(key, prefix, year)
+            first = await self._reserve(key, prefix, year, self.block_size)
+            self._blocks[key] = [first + 1, first + self.block_size - 1]
+            return first
+    
+    async def reserve_many(self, prefix: str, year: int, count: int) -> int:
+        """Claim count consecutive numbers in one round trip and return the first"""
+        key = f"{prefix}-{year}"
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            await self._ensure_seeded(key, prefix, year)
+        return await self._reserve(key, prefix, year, count)
+    
+    async def advance_past(self, prefix: str, year: int, number: int):
+        """Make sure a number issued elsewhere (e.g. an import) is never handed out again"""
+        key = f"{prefix}-{year}"
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            await self._ensure_seeded(key, prefix, year)
+            # Numbers this worker already reserved up to and including it are spent too
+            block = self._blocks.get(key)
+            if block and block[0] <= number:
+                block[0] = number + 1
+        await db.counters.update_one(
+            {"_id": key},
+            {"$max": {"value": number}, "$setOnInsert": {"prefix": prefix, "year": year}},
+            upsert=True
+        )
+    
+    async def _reserve(self, key: str, prefix: str, year: int, count: int) -> int:
+        """Atomically claim the next count numbers and return the first"""
+        counter = await db.counters.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"value": count}, "$setOnInsert": {"prefix": prefix, "year": year}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["value"] - count + 1
+    
+    async def _ensure_seeded(self, key: str, prefix: str, year: int):
+        """Start a new series after the highest number already issued, e.g. by the old count-based scheme"""
+        if key in self._seeded:
+            return
+        if not await db.counters.find_one({"_id": key}, {"_id": 1}):
+            field = SEQUENCE_FIELDS[prefix]
+            highest = 0
+            async for doc in db.purchases.find({field: {"$regex": f"^{year}-{prefix}-"}}, {"_id": 0, field: 1}):
+                suffix = doc[field].rsplit("-", 1)[-1]
+                if suffix.isdigit():
+                    highest = max(highest, int(suffix))
+            # $max keeps this safe if another worker seeds or allocates concurrently
+            await db.counters.update_one(
+                {"_id": key},
+                {"$max": {"value": highest}, "$setOnInsert": {"prefix": prefix, "year": year}},
+                upsert=True
+            )
+        self._seeded.add(key)
+
+document_sequences = SequenceAllocator(SEQUENCE_BLOCK_SIZE)
 
 def create_audit_entry(action: str, user: str = "System", details: str = "", prev_value: str = None, new_value: str = None) -> dict:
     """Create an audit trail entry"""
     return {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": utc_now(),
         "action": action,
         "user": user,
         "details": details,
@@ -198,309 +758,2064 @@ def create_audit_entry(action: str, user: str = "System", details: str = "", pre
         "newValue": new_value
     }
 
+def audit_document(purchase_id: str, entry: dict) -> dict:
+    """Turn an audit entry into a document of the append-only purchase_audit collection"""
+    return {**entry, "id": entry.get("id") or str(uuid.uuid4()), "purchaseId": purchase_id}
 
-# ==================== API Routes ====================
+async def append_audit(purchase_id: str, entry: dict, session=None):
+    await db.purchase_audit.insert_one(audit_document(purchase_id, entry), session=session)
 
-@api_router.get("/")
-async def root():
-    return {"message": "MDRRMO Procurement System API", "version": "2.0"}
+def encode_cursor(doc: dict, keys: tuple = ("createdAt", "id")) -> str:
+    """Encode the sort key of the last document of a page as an opaque cursor"""
+    # Extended JSON so datetime keys decode back to datetimes
+    payload = json_util.dumps({key: doc.get(key) for key in keys})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
 
-# Create new purchase
-@api_router.post("/purchases", response_model=Purchase)
-async def create_purchase(purchase_data: PurchaseCreate):
+def decode_cursor(cursor: str, keys: tuple = ("createdAt", "id")) -> dict:
+    """Decode a cursor produced by encode_cursor"""
     try:
-        # Get current count for ID generation
-        count = await db.purchases.count_documents({})
-        
-        # Generate IDs
-        purchase_dict = purchase_data.model_dump()
-        purchase_dict["id"] = str(uuid.uuid4())
-        purchase_dict["prNo"] = generate_id("PR", count)
-        purchase_dict["poNo"] = generate_id("PO", count)
-        purchase_dict["obrNo"] = generate_id("OBR", count)
-        purchase_dict["dvNo"] = generate_id("DV", count)
-        purchase_dict["createdAt"] = datetime.now(timezone.utc).isoformat()
-        
-        # Initialize new fields
-        purchase_dict["approvalInfo"] = {"approvedBy": "", "approvedAt": None, "comments": "", "signature": ""}
-        purchase_dict["attachments"] = []
-        purchase_dict["auditTrail"] = [
-            create_audit_entry("created", purchase_data.createdBy, f"Purchase request '{purchase_data.title}' created")
-        ]
-        
-        # Insert into database
-        await db.purchases.insert_one(purchase_dict)
-        
-        # Create notification for new purchase
-        await create_notification_internal(
-            "purchase_created",
-            "New Purchase Request",
-            f"Purchase request '{purchase_data.title}' has been created and is pending approval.",
-            purchase_dict["id"]
-        )
-        
-        # Return created purchase
-        created_purchase = await db.purchases.find_one({"id": purchase_dict["id"]}, {"_id": 0})
-        return Purchase(**created_purchase)
-    
-    except Exception as e:
-        logging.error(f"Error creating purchase: {e}")
-        raise HTTPException(status_code=500, detail=f"Error creating purchase: {str(e)}")
+        payload = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return {key: payload[key] for key in keys}
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-# Get all purchases with optional filtering
-@api_router.get("/purchases", response_model=List[Purchase])
-async def get_purchases(
-    status: Optional[str] = Query(None, description="Filter by status"),
-    priority: Optional[str] = Query(None, description="Filter by priority"),
-    department: Optional[str] = Query(None, description="Filter by department"),
-    date_from: Optional[str] = Query(None, description="Filter by start date"),
-    date_to: Optional[str] = Query(None, description="Filter by end date"),
-    min_amount: Optional[float] = Query(None, description="Filter by minimum amount"),
-    max_amount: Optional[float] = Query(None, description="Filter by maximum amount"),
-    search: Optional[str] = Query(None, description="Search in title, PR number")
-):
-    try:
-        # Build query filter
-        query = {}
-        
-        if status:
-            query["status"] = status
-        if priority:
-            query["priority"] = priority
-        if department:
-            query["department"] = department
-        if date_from or date_to:
-            date_filter = {}
+def parse_fields(fields: Optional[str]) -> Optional[dict]:
+    """Turn a comma-separated field list into a Mongo projection"""
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in Purchase.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    # id and createdAt are always needed to build the next cursor
+    projection = {"_id": 0, "id": 1, "createdAt": 1}
+    for f in requested:
+        projection[f] = 1
+    return projection
+
+def model_defaults(model) -> dict:
+    """Serialized defaults of a model's optional fields"""
+    defaults = {}
+    for name, field in model.model_fields.items():
+        if field.is_required() or field.default_factory is not None:
+            continue
+        value = field.get_default()
+        defaults[name] = value.model_dump() if isinstance(value, BaseModel) else value
+    return defaults
+
+# Trusted reads: documents in our own collections were validated by the models when
+# they were written, so read routes return them as-is instead of building every
+# nested model again. Missing optional fields are filled from the model defaults and
+# the projection keeps out anything the model doesn't declare.
+PURCHASE_DEFAULTS = model_defaults(Purchase)
+PURCHASE_PROJECTION = {"_id": 0, **{name: 1 for name in Purchase.model_fields}}
+AUDIT_DEFAULTS = model_defaults(AuditEntry)
+
+def trusted_purchase(doc: dict) -> dict:
+    return format_purchase_dates({**PURCHASE_DEFAULTS, **doc})
+
+async def count_purchases(query: dict) -> int:
+    """Total for a purchase listing; without filters the collection metadata count avoids a scan"""
+    if not query:
+        return await db.purchases.estimated_document_count()
+    return await db.purchases.count_documents(query)
+
+def purchase_page_response(items: List[dict], total: Optional[int], has_more: bool, next_cursor: Optional[str]) -> ORJSONResponse:
+    """PurchasePage body rendered directly, skipping response_model validation"""
+    return ORJSONResponse({"items": items, "total": total, "hasMore": has_more, "nextCursor": next_cursor})
+
+def build_purchase_query(
+    status: Optional[str] = None,
+    priority: Optional[str] = None,
+    department: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    search: Optional[str] = None
+) -> dict:
+    """Build the Mongo filter shared by the purchase list endpoints"""
+    query = {}
+    
+    if status:
+        query["status"] = status
+    if priority:
+        query["priority"] = priority
+    if department:
+        query["department"] = department
+    if date_from or date_to:
+        date_filter = {}
+        try:
             if date_from:
-                date_filter["$gte"] = date_from
+                date_filter["$gte"] = parse_date(date_from)
             if date_to:
-                date_filter["$lte"] = date_to
-            if date_filter:
-                query["date"] = date_filter
-        if min_amount is not None or max_amount is not None:
-            amount_filter = {}
-            if min_amount is not None:
-                amount_filter["$gte"] = min_amount
-            if max_amount is not None:
-                amount_filter["$lte"] = max_amount
-            if amount_filter:
-                query["totalAmount"] = amount_filter
-        if search:
-            query["$or"] = [
-                {"title": {"$regex": search, "$options": "i"}},
-                {"prNo": {"$regex": search, "$options": "i"}},
-                {"poNo": {"$regex": search, "$options": "i"}}
-            ]
-        
-        purchases = await db.purchases.find(query, {"_id": 0}).to_list(1000)
-        return [Purchase(**p) for p in purchases]
-    except Exception as e:
-        logging.error(f"Error fetching purchases: {e}")
-        raise HTTPException(status_code=500, detail=f"Error fetching purchases: {str(e)}")
+                date_filter["$lte"] = parse_date(date_to)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Dates must be given as YYYY-MM-DD")
+        if date_filter:
+            query["date"] = date_filter
+    if min_amount is not None or max_amount is not None:
+        amount_filter = {}
+        if min_amount is not None:
+            amount_filter["$gte"] = to_centavos(min_amount)
+        if max_amount is not None:
+            amount_filter["$lte"] = to_centavos(max_amount)
+        if amount_filter:
+            query["totalCentavos"] = amount_filter
+    if search:
+        search_clause = build_search_clause(search)
+        if search_clause:
+            query.update(search_clause)
+    
+    return query
 
-# Get single purchase by ID
-@api_router.get("/purchases/{purchase_id}", response_model=Purchase)
-async def get_purchase(purchase_id: str):
-    try:
-        purchase = await db.purchases.find_one({"id": purchase_id}, {"_id": 0})
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Purchase not found")
-        return Purchase(**purchase)
-    except HTTPException:
-        raise
-    except Exception as e:
-        logging.error(f"Error fetching purchase: {e}")
-        raise HTTPException(status_code=500, detail=f"Error fetching purchase: {str(e)}")
+# A year, optionally followed by a series and the start of a number: 2025, 2025-PR, 2025-PR-01
+DOCUMENT_NUMBER_PREFIX = re.compile(r"^\d{4}(-[A-Za-z]{0,3}(-\d*)?)?$")
+# A number without its year, with or without the series: PR-001, 001
+DOCUMENT_NUMBER_SUFFIX = re.compile(r"^(?:([A-Za-z]{2,3})-)?(\d+)$")
 
-# Update purchase
-@api_router.put("/purchases/{purchase_id}", response_model=Purchase)
-async def update_purchase(purchase_id: str, purchase_data: PurchaseCreate):
-    try:
-        # Check if purchase exists
-        existing = await db.purchases.find_one({"id": purchase_id})
-        if not existing:
-            raise HTTPException(status_code=404, detail="Purchase not found")
-        
-        # Update purchase
-        update_dict = purchase_data.model_dump()
-        update_dict["updatedAt"] = datetime.now(timezone.utc).isoformat()
-        
-        # Add audit trail entry
-        changes = []
-        if existing.get("title") != update_dict.get("title"):
-            changes.append(f"Title changed from '{existing.get('title')}' to '{update_dict.get('title')}'")
-        if existing.get("totalAmount") != update_dict.get("totalAmount"):
-            changes.append(f"Amount changed from {existing.get('totalAmount')} to {update_dict.get('totalAmount')}")
-        if existing.get("status") != update_dict.get("status"):
-            changes.append(f"Status changed from '{existing.get('status')}' to '{update_dict.get('status')}'")
-        
-        audit_entry = create_audit_entry(
-            "updated",
-            purchase_data.createdBy,
-            "; ".join(changes) if changes else "Purchase details updated"
-        )
-        
-        await db.purchases.update_one(
-            {"id": purchase_id},
-            {
-                "$set": update_dict,
-                "$push": {"auditTrail": audit_entry}
-            }
-        )
-        
-        # Return updated purchase
-        updated = await db.purchases.find_one({"id": purchase_id}, {"_id": 0})
-        return Purchase(**updated)
+def build_search_clause(search: str) -> Optional[dict]:
+    """Translate free-text search input into an index-backed filter"""
+    term = search.strip()
+    if not term:
+        return None
     
-    except HTTPException:
-        raise
-    except Exception as e:
-        logging.error(f"Error updating purchase: {e}")
-        raise HTTPException(status_code=500, detail=f"Error updating purchase: {str(e)}")
+    # Document numbers match by anchored prefix, which can walk the number indexes
+    clauses = []
+    if DOCUMENT_NUMBER_PREFIX.match(term):
+        prefix = f"^{re.escape(term.upper())}"
+        clauses = [{field: {"$regex": prefix}} for field in SEQUENCE_FIELDS.values()]
+    # Without the year there is no literal prefix, but the pattern is still checked
+    # against the keys of the number indexes rather than by fetching documents
+    suffix = DOCUMENT_NUMBER_SUFFIX.match(term)
+    if suffix:
+        series, number = suffix.groups()
+        clauses += [
+            {field: {"$regex": f"^\\d{{4}}-{prefix}-{number}"}}
+            for prefix, field in SEQUENCE_FIELDS.items()
+            if series is None or series.upper() == prefix
+        ]
+    if clauses:
+        return {"$or": clauses}
+    
+    # Everything else goes to the text index. Quotes and leading minus signs are
+    # $text syntax (phrases, negation), so they are stripped to keep input literal
+    words = [word.lstrip("-").replace('"', "") for word in term.split()]
+    words = [word for word in words if word]
+    if not words:
+        return None
+    return {"$text": {"$search": " ".join(words)}}
 
-# Update purchase status with approval workflow
-@api_router.patch("/purchases/{purchase_id}/status", response_model=Purchase)
-async def update_purchase_status(purchase_id: str, status_update: StatusUpdate):
-    try:
-        # Check if purchase exists
-        existing = await db.purchases.find_one({"id": purchase_id})
-        if not existing:
-            raise HTTPException(status_code=404, detail="Purchase not found")
-        
-        old_status = existing.get("status", "Pending")
-        new_status = status_update.status
-        
-        # Build update
-        update_data = {
-            "status": new_status,
-            "updatedAt": datetime.now(timezone.utc).isoformat()
-        }
-        
-        # If approved or denied, update approval info
-        if new_status in ["Approved", "Denied"]:
-            update_data["approvalInfo"] = {
-                "approvedBy": status_update.approvedBy or "System",
-                "approvedAt": datetime.now(timezone.utc).isoformat(),
-                "comments": status_update.comments,
-                "signature": ""
-            }
-        
-        # Create audit entry
-        action = "status_changed"
-        if new_status == "Approved":
-            action = "approved"
-        elif new_status == "Denied":
-            action = "denied"
-        
-        audit_entry = create_audit_entry(
-            action,
-            status_update.approvedBy or "System",
-            status_update.comments or f"Status changed from {old_status} to {new_status}",
-            old_status,
-            new_status
-        )
-        
-        # Update status
-        await db.purchases.update_one(
-            {"id": purchase_id},
-            {
-                "$set": update_data,
-                "$push": {"auditTrail": audit_entry}
-            }
+
+# ==================== Indexes ====================
+
+# Managed indexes carry this prefix so reconciliation never touches indexes
+# created by hand in the database
+INDEX_PREFIX = "mdrrmo_"
+
+# Fields covered by free-text search and their relevance weights
+SEARCH_WEIGHTS = {
+    "title": 10,
+    "items.name": 5,
+    "department": 3,
+    "supplier1.name": 3,
+    "supplier2.name": 2,
+    "supplier3.name": 2,
+    "purpose": 2,
+    "items.description": 1,
+}
+
+INDEX_SPECS = {
+    "purchases": [
+        IndexModel([("id", ASCENDING)], name=f"{INDEX_PREFIX}id", unique=True),
+        IndexModel([("prNo", ASCENDING)], name=f"{INDEX_PREFIX}prNo", unique=True),
+        # Default list order and keyset pagination
+        IndexModel([("createdAt", DESCENDING), ("id", DESCENDING)], name=f"{INDEX_PREFIX}createdAt_id"),
+        # Filter combinations used by get_purchases, each followed by the list sort key
+        IndexModel([("status", ASCENDING), ("createdAt", DESCENDING), ("id", DESCENDING)], name=f"{INDEX_PREFIX}status_createdAt"),
+        IndexModel([("priority", ASCENDING), ("createdAt", DESCENDING), ("id", DESCENDING)], name=f"{INDEX_PREFIX}priority_createdAt"),
+        IndexModel([("department", ASCENDING), ("status", ASCENDING), ("createdAt", DESCENDING)], name=f"{INDEX_PREFIX}department_status_createdAt"),
+        IndexModel([("date", ASCENDING)], name=f"{INDEX_PREFIX}date"),
+        IndexModel([("totalCentavos", ASCENDING)], name=f"{INDEX_PREFIX}totalCentavos"),
+        # Document number prefix search (prNo is covered by its unique index)
+        IndexModel([("poNo", ASCENDING)], name=f"{INDEX_PREFIX}poNo"),
+        IndexModel([("obrNo", ASCENDING)], name=f"{INDEX_PREFIX}obrNo"),
+        IndexModel([("dvNo", ASCENDING)], name=f"{INDEX_PREFIX}dvNo"),
+        IndexModel(
+            [(field, TEXT) for field in SEARCH_WEIGHTS],
+            name=f"{INDEX_PREFIX}search",
+            weights=SEARCH_WEIGHTS,
+            default_language="none"
+        ),
+    ],
+    "purchase_audit": [
+        IndexModel([("id", ASCENDING)], name=f"{INDEX_PREFIX}id", unique=True),
+        IndexModel([("purchaseId", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], name=f"{INDEX_PREFIX}purchaseId_timestamp"),
+    ],
+    "attachment_uploads": [
+        IndexModel([("id", ASCENDING)], name=f"{INDEX_PREFIX}id", unique=True),
+        # Abandoned resumable uploads expire on their own
+        IndexModel([("expiresAt", ASCENDING)], name=f"{INDEX_PREFIX}expiresAt", expireAfterSeconds=0),
+    ],
+    "attachment_blobs": [
+        IndexModel([("refCount", ASCENDING)], name=f"{INDEX_PREFIX}refCount"),
+    ],
+    "notifications": [
+        IndexModel([("id", ASCENDING)], name=f"{INDEX_PREFIX}id", unique=True),
+        # Newest-first pages
+        IndexModel([("createdAt", DESCENDING), ("id", DESCENDING)], name=f"{INDEX_PREFIX}createdAt_id"),
+        # Unread counts above a read watermark
+        IndexModel([("seq", DESCENDING)], name=f"{INDEX_PREFIX}seq"),
+        IndexModel([("expiresAt", ASCENDING)], name=f"{INDEX_PREFIX}expiresAt", expireAfterSeconds=0),
+    ],
+    "notification_outbox": [
+        IndexModel([("id", ASCENDING)], name=f"{INDEX_PREFIX}id", unique=True),
+        # Worker claim query: due entries, oldest first
+        IndexModel([("status", ASCENDING), ("nextAttemptAt", ASCENDING)], name=f"{INDEX_PREFIX}status_nextAttemptAt"),
+        IndexModel([("dedupeKey", ASCENDING), ("status", ASCENDING)], name=f"{INDEX_PREFIX}dedupeKey_status"),
+        IndexModel([("lease", ASCENDING)], name=f"{INDEX_PREFIX}lease", sparse=True),
+        # Delivered entries are only kept for troubleshooting
+        IndexModel([("deliveredAt", ASCENDING)], name=f"{INDEX_PREFIX}deliveredAt", expireAfterSeconds=OUTBOX_RETENTION_DAYS * 24 * 60 * 60),
+    ],
+}
+
+def _index_matches(existing: dict, model: IndexModel) -> bool:
+    """Check whether an index from index_information() matches a declared IndexModel"""
+    spec = model.document
+    if TEXT in spec["key"].values():
+        # Text indexes are reported as _fts/_ftsx keys, so compare what they cover instead
+        return (
+            dict(existing.get("weights", {})) == spec.get("weights", {})
+            and existing.get("default_language") == spec.get("default_language", "english")
         )
+    return (
+        [tuple(k) for k in existing.get("key", [])] == list(spec["key"].items())
+        and bool(existing.get("unique", False)) == bool(spec.get("unique", False))
+        and existing.get("expireAfterSeconds") == spec.get("expireAfterSeconds")
+        and existing.get("partialFilterExpression") == spec.get("partialFilterExpression")
+    )
+
+async def ensure_indexes():
+    """Create declared indexes, rebuild changed ones and drop managed indexes no longer declared"""
+    for collection_name, models in INDEX_SPECS.items():
+        collection = db[collection_name]
+        try:
+            existing = await collection.index_information()
+        except Exception as e:
+            logging.error(f"Could not read indexes for {collection_name}: {e}")
+            continue
         
-        # Create notification
-        notification_title = f"Purchase {new_status}"
-        notification_message = f"Purchase request '{existing.get('title')}' has been {new_status.lower()}."
-        if status_update.comments:
-            notification_message += f" Comment: {status_update.comments}"
-        
-        await create_notification_internal(
-            "status_changed",
-            notification_title,
-            notification_message,
-            purchase_id
-        )
+        declared = {m.document["name"]: m for m in models}
+        for name, info in existing.items():
+            if not name.startswith(INDEX_PREFIX):
+                continue
+            if name not in declared or not _index_matches(info, declared[name]):
+                logging.info(f"Dropping index {collection_name}.{name}")
+                await collection.drop_index(name)
         
-        # Return updated purchase
-        updated = await db.purchases.find_one({"id": purchase_id}, {"_id": 0})
-        return Purchase(**updated)
+        # Create one at a time so a single failure (e.g. duplicate keys on a
+        # unique index) doesn't prevent the rest from being built
+        for name, model in declared.items():
+            try:
+                await collection.create_indexes([model])
+            except OperationFailure as e:
+                logging.error(f"Could not create index {collection_name}.{name}: {e}")
+
+
+# ==================== Dashboard Stats ====================
+
+def _count_if(condition: dict) -> dict:
+    return {"$sum": {"$cond": [condition, 1, 0]}}
+
+# Denied purchases don't count towards committed amounts. Amounts are summed in
+# whole centavos so totals stay exact; DashboardStats reports them in pesos.
+_COMMITTED_AMOUNT = {
+    "$sum": {"$cond": [{"$ne": ["$status", "Denied"]}, {"$ifNull": ["$totalCentavos", 0]}, 0]}
+}
+
+def dashboard_stats_pipeline(match: dict, recent_since: datetime) -> list:
+    """Single-pass aggregation returning totals and breakdowns for the dashboard"""
+    def breakdown(group_key) -> list:
+        return [
+            {"$group": {"_id": group_key, "count": {"$sum": 1}, "totalCentavos": _COMMITTED_AMOUNT}},
+            {"$sort": {"_id": 1}},
+            {"$project": {"_id": 0, "key": {"$ifNull": ["$_id", ""]}, "count": 1, "totalCentavos": 1}}
+        ]
     
-    except HTTPException:
-        raise
-    except Exception as e:
-        logging.error(f"Error updating status: {e}")
-        raise HTTPException(status_code=500, detail=f"Error updating status: {str(e)}")
+    return [
+        {"$match": match},
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": None,
+                    "total": {"$sum": 1},
+                    "approved": _count_if({"$eq": ["$status", "Approved"]}),
+                    "pending": _count_if({"$eq": ["$status", "Pending"]}),
+                    "denied": _count_if({"$eq": ["$status", "Denied"]}),
+                    "completed": _count_if({"$eq": ["$status", "Completed"]}),
+                    "forReview": _count_if({"$eq": ["$status", "For Review"]}),
+                    "totalCentavos": _COMMITTED_AMOUNT,
+                    "highPriority": _count_if({"$in": ["$priority", ["High", "Urgent"]]}),
+                    "recentActivity": _count_if({"$gte": ["$createdAt", recent_since]})
+                }},
+                {"$project": {"_id": 0}}
+            ],
+            "byDepartment": breakdown("$department"),
+            "byMonth": breakdown({"$dateToString": {"format": "%Y-%m", "date": "$date", "onNull": ""}})
+        }}
+    ]
 
-# Delete purchase
-@api_router.delete("/purchases/{purchase_id}")
-async def delete_purchase(purchase_id: str):
-    try:
-        result = await db.purchases.delete_one({"id": purchase_id})
-        if result.deleted_count == 0:
-            raise HTTPException(status_code=404, detail="Purchase not found")
-        return {"message": "Purchase deleted successfully", "id": purchase_id}
-    except HTTPException:
-        raise
-    except Exception as e:
-        logging.error(f"Error deleting purchase: {e}")
-        raise HTTPException(status_code=500, detail=f"Error deleting purchase: {str(e)}")
+# Materialized dashboard counters. The "totals" document mirrors the totals
+# facet above; one document per department and per month mirrors the
+# breakdown facets. Writes apply $inc deltas so the dashboard never scans.
+STATS_TOTALS_ID = "totals"
 
-# Get dashboard statistics
-@api_router.get("/purchases/stats/dashboard", response_model=DashboardStats)
-async def get_dashboard_stats():
-    try:
-        purchases = await db.purchases.find({}, {"_id": 0}).to_list(1000)
-        
-        # Calculate recent activity (last 7 days)
-        from datetime import timedelta
-        seven_days_ago = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
-        recent_count = len([p for p in purchases if p.get("createdAt", "") >= seven_days_ago])
-        
-        stats = {
-            "total": len(purchases),
-            "approved": len([p for p in purchases if p.get("status") == "Approved"]),
-            "pending": len([p for p in purchases if p.get("status") == "Pending"]),
-            "denied": len([p for p in purchases if p.get("status") == "Denied"]),
-            "completed": len([p for p in purchases if p.get("status") == "Completed"]),
-            "forReview": len([p for p in purchases if p.get("status") == "For Review"]),
-            "totalAmount": sum(p.get("totalAmount", 0) for p in purchases if p.get("status") != "Denied"),
-            "highPriority": len([p for p in purchases if p.get("priority") in ["High", "Urgent"]]),
-            "recentActivity": recent_count
-        }
-        
-        return DashboardStats(**stats)
-    except Exception as e:
-        logging.error(f"Error fetching stats: {e}")
-        raise HTTPException(status_code=500, detail=f"Error fetching stats: {str(e)}")
+STATUS_COUNTERS = {
+    "Approved": "approved",
+    "Pending": "pending",
+    "Denied": "denied",
+    "Completed": "completed",
+    "For Review": "forReview",
+}
 
+STATS_TOTAL_FIELDS = [
+    "total", "approved", "pending", "denied", "completed", "forReview", "totalCentavos", "highPriority"
+]
 
-# ==================== Notifications API ====================
+def committed_amount(purchase: dict) -> int:
+    if purchase.get("status") == "Denied":
+        return 0
+    return purchase.get("totalCentavos") or 0
 
-async def create_notification_internal(type: str, title: str, message: str, purchase_id: str = None):
-    """Internal helper to create notification"""
-    notification = {
-        "id": str(uuid.uuid4()),
-        "type": type,
-        "title": title,
-        "message": message,
-        "purchaseId": purchase_id,
-        "read": False,
-        "createdAt": datetime.now(timezone.utc).isoformat()
+def stats_deltas(purchase: dict, sign: int) -> Dict[str, Dict[str, int]]:
+    """Counter increments contributed by one purchase, keyed by stats document id"""
+    amount = committed_amount(purchase)
+    totals = {"total": sign, "totalCentavos": sign * amount}
+    status_field = STATUS_COUNTERS.get(purchase.get("status"))
+    if status_field:
+        totals[status_field] = sign
+    if purchase.get("priority") in ["High", "Urgent"]:
+        totals["highPriority"] = sign
+    
+    bucket = {"count": sign, "totalCentavos": sign * amount}
+    return {
+        STATS_TOTALS_ID: totals,
+        f"department:{purchase.get('department') or ''}": dict(bucket),
+        f"month:{month_key(purchase.get('date'))}": dict(bucket),
     }
-    await db.notifications.insert_one(notification)
-    return notification
 
-@api_router.get("/notifications", response_model=List[Notification])
-async def get_notifications(unread_only: bool = Query(False)):
-    try:
-        query = {"read": False} if unread_only else {}
-        notifications = await db.notifications.find(query, {"_id": 0}).sort("createdAt", -1).to_list(100)
-        return [Notification(**n) for n in notifications]
+async def apply_stats_change(before: Optional[dict], after: Optional[dict]):
+    """Move the materialized counters from the before-image to the after-image of a purchase"""
+    await apply_stats_changes([(before, after)])
+
+async def apply_stats_changes(changes: List[tuple]):
+    """Apply many (before, after) purchase changes to the counters in one bulk write"""
+    combined: Dict[str, Dict[str, int]] = {}
+    for before, after in changes:
+        for purchase, sign in ((before, -1), (after, 1)):
+            if not purchase:
+                continue
+            for doc_id, fields in stats_deltas(purchase, sign).items():
+                target = combined.setdefault(doc_id, {})
+                for field, delta in fields.items():
+                    target[field] = target.get(field, 0) + delta
+    
+    operations = []
+    for doc_id, fields in combined.items():
+        inc = {field: delta for field, delta in fields.items() if delta}
+        if not inc:
+            continue
+        update = {"$inc": inc}
+        if doc_id != STATS_TOTALS_ID:
+            kind, key = doc_id.split(":", 1)
+            update["$setOnInsert"] = {"kind": kind, "key": key}
+        operations.append(UpdateOne({"_id": doc_id}, update, upsert=True))
+    
+    if not operations:
+        return
+    # The purchase write already succeeded; drift is repaired by /admin/stats/rebuild
+    try:
+        await db.purchase_stats.bulk_write(operations, ordered=False)
+    except Exception as e:
+        logging.error(f"Error updating dashboard counters: {e}")
+
+async def compute_dashboard_stats(match: dict) -> dict:
+    """Run the dashboard aggregation and flatten its facets"""
+    seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
+    result = await db.purchases.aggregate(dashboard_stats_pipeline(match, seven_days_ago)).to_list(1)
+    facets = result[0] if result else {}
+    totals = (facets.get("totals") or [{}])[0]
+    
+    stats = {field: totals.get(field, 0) for field in STATS_TOTAL_FIELDS}
+    stats["recentActivity"] = totals.get("recentActivity", 0)
+    stats["byDepartment"] = facets.get("byDepartment", [])
+    stats["byMonth"] = facets.get("byMonth", [])
+    return stats
+
+async def read_materialized_stats() -> Optional[dict]:
+    """Read the counters maintained by apply_stats_change, or None if they were never built"""
+    docs = await db.purchase_stats.find({}).to_list(None)
+    totals = next((d for d in docs if d["_id"] == STATS_TOTALS_ID), None)
+    if totals is None:
+        return None
+    
+    def buckets(kind: str) -> list:
+        return sorted(
+            (
+                {"key": d["key"], "count": d.get("count", 0), "totalCentavos": d.get("totalCentavos", 0)}
+                for d in docs
+                if d.get("kind") == kind and d.get("count", 0) > 0
+            ),
+            key=lambda b: b["key"]
+        )
+    
+    stats = {field: totals.get(field, 0) for field in STATS_TOTAL_FIELDS}
+    stats["byDepartment"] = buckets("department")
+    stats["byMonth"] = buckets("month")
+    return stats
+
+async def rebuild_dashboard_stats() -> dict:
+    """Recompute the materialized counters from the purchases collection"""
+    stats = await compute_dashboard_stats({})
+    
+    operations = [
+        UpdateOne(
+            {"_id": STATS_TOTALS_ID},
+            {"$set": {field: stats[field] for field in STATS_TOTAL_FIELDS}},
+            upsert=True
+        )
+    ]
+    keep = [STATS_TOTALS_ID]
+    for kind, rows in (("department", stats["byDepartment"]), ("month", stats["byMonth"])):
+        for row in rows:
+            doc_id = f"{kind}:{row['key']}"
+            keep.append(doc_id)
+            operations.append(UpdateOne(
+                {"_id": doc_id},
+                {"$set": {"kind": kind, "key": row["key"], "count": row["count"], "totalCentavos": row["totalCentavos"]}},
+                upsert=True
+            ))
+    
+    await db.purchase_stats.bulk_write(operations, ordered=False)
+    await db.purchase_stats.delete_many({"_id": {"$nin": keep}})
+    return stats
+
+def diff_stats(materialized: Optional[dict], actual: dict) -> dict:
+    """Fields whose materialized value disagrees with a fresh aggregation"""
+    if materialized is None:
+        return {"missing": True}
+    
+    def close(a, b) -> bool:
+        return (a or 0) == (b or 0)
+    
+    differences = {}
+    for field in STATS_TOTAL_FIELDS:
+        if not close(materialized.get(field), actual.get(field)):
+            differences[field] = {"materialized": materialized.get(field), "actual": actual.get(field)}
+    for breakdown in ("byDepartment", "byMonth"):
+        have = {b["key"]: b for b in materialized[breakdown]}
+        want = {b["key"]: b for b in actual[breakdown]}
+        for key in set(have) | set(want):
+            h, w = have.get(key, {}), want.get(key, {})
+            if not (close(h.get("count"), w.get("count")) and close(h.get("totalCentavos"), w.get("totalCentavos"))):
+                differences.setdefault(breakdown, {})[key] = {"materialized": h or None, "actual": w or None}
+    return differences
+
+def dashboard_stats_response(stats: dict) -> DashboardStats:
+    """Report the centavo counters as peso amounts"""
+    def breakdown(rows: list) -> list:
+        return [
+            {"key": row["key"], "count": row["count"], "totalAmount": from_centavos(row.get("totalCentavos"))}
+            for row in rows
+        ]
+    
+    return DashboardStats(
+        **{field: stats.get(field, 0) for field in STATS_TOTAL_FIELDS if field != "totalCentavos"},
+        totalAmount=from_centavos(stats.get("totalCentavos")),
+        recentActivity=stats.get("recentActivity", 0),
+        byDepartment=breakdown(stats.get("byDepartment", [])),
+        byMonth=breakdown(stats.get("byMonth", []))
+    )
+
+
+# ==================== Write Path ====================
+
+# Decided at startup by detect_transaction_support
+transactions_enabled = False
+
+async def is_replicated_deployment() -> bool:
+    """Transactions and change streams need a replica set or mongos"""
+    try:
+        hello = await client.admin.command("hello")
+        return "setName" in hello or hello.get("msg") == "isdbgrid"
+    except Exception as e:
+        logging.warning(f"Could not detect MongoDB deployment type: {e}")
+        return False
+
+async def detect_transaction_support() -> bool:
+    """Transactions need a replica set or mongos; a standalone server rejects them"""
+    if MONGO_TRANSACTIONS in ("false", "0", "no"):
+        return False
+    supported = await is_replicated_deployment()
+    if MONGO_TRANSACTIONS in ("true", "1", "yes") and not supported:
+        raise RuntimeError("MONGO_TRANSACTIONS=true but the MongoDB deployment does not support transactions")
+    return supported
+
+async def run_purchase_write(write, *side_effects, committed=None):
+    """
+    Run a purchase mutation together with its audit entry and notification.
+    
+    write(session) performs the purchase write and returns a result, or None when
+    there was nothing to write (e.g. the purchase doesn't exist). Each side effect
+    is called as effect(session, result). With transactions everything commits or
+    aborts together and transient errors are retried by with_transaction; without
+    them the write goes first and the independent inserts run concurrently.
+    
+    committed(result) runs once the purchase write is durable, even when a side
+    effect fails after it, so counters and caches never miss a stored change.
+    """
+    if transactions_enabled:
+        async def callback(session):
+            result = await write(session)
+            if result is not None:
+                # Operations within one session must not overlap
+                for effect in side_effects:
+                    await effect(session, result)
+            return result
+        
+        async with await client.start_session() as session:
+            result = await session.with_transaction(callback)
+        if result is not None and committed:
+            await committed(result)
+        return result
+    
+    result = await write(None)
+    if result is not None:
+        try:
+            await asyncio.gather(*(effect(None, result) for effect in side_effects))
+        finally:
+            if committed:
+                await committed(result)
+    return result
+
+
+# ==================== Event Stream ====================
+
+# Decided at startup; without change streams events are published by the write paths
+change_streams_enabled = False
+
+STREAM_PURCHASE_FIELDS = ["id", "prNo", "title", "status", "updatedAt"]
+STREAM_NOTIFICATION_FIELDS = ["id", "type", "title", "message", "purchaseId", "createdAt"]
+
+CHANGE_STREAM_PIPELINE = [
+    {"$match": {"$or": [
+        {"ns.coll": "notifications", "operationType": "insert"},
+        {"ns.coll": "purchases", "operationType": "insert"},
+        {"ns.coll": "purchases", "operationType": "update",
+         "updateDescription.updatedFields.status": {"$exists": True}},
+    ]}},
+    {"$project": {
+        "operationType": 1,
+        "ns": 1,
+        **{f"fullDocument.{field}": 1 for field in set(STREAM_PURCHASE_FIELDS + STREAM_NOTIFICATION_FIELDS)},
+    }},
+]
+
+class EventBroker:
+    """
+    Fans events out to connected /api/stream clients.
+    
+    The most recent events are kept so a reconnecting client can replay what it
+    missed. Each subscriber has a bounded queue; one that falls behind loses its
+    backlog and receives a reset event instead of slowing everyone down.
+    """
+    def __init__(self):
+        self.subscribers: set = set()
+        self.history = collections.deque(maxlen=STREAM_HISTORY_SIZE)
+        self._prefix = uuid.uuid4().hex[:8]
+        self._sequence = 0
+    
+    def last_id(self) -> Optional[str]:
+        return self.history[-1]["id"] if self.history else None
+    
+    def publish(self, event_type: str, data: dict, event_id: str = None):
+        if event_id is None:
+            # Only unique within this process; change stream events carry resume tokens
+            self._sequence += 1
+            event_id = f"{self._prefix}-{self._sequence}"
+        event = {"id": event_id, "type": event_type, "data": data}
+        self.history.append(event)
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(stream_reset_event("lagged"))
+    
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+    
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+    
+    def replay_after(self, event_id: str) -> Optional[List[dict]]:
+        """Events published after event_id, or None when it is no longer in the buffer"""
+        history = list(self.history)
+        for index, event in enumerate(history):
+            if event["id"] == event_id:
+                return history[index + 1:]
+        return None
+
+event_broker = EventBroker()
+
+def stream_reset_event(reason: str) -> dict:
+    """Tells the client to refetch; carries the latest id so it resumes from here on reconnect"""
+    return {"id": event_broker.last_id(), "type": "reset", "data": {"reason": reason}}
+
+def purchase_event_data(purchase: dict, operation: str) -> dict:
+    data = {field: purchase.get(field) for field in STREAM_PURCHASE_FIELDS}
+    return {"operation": operation, **format_purchase_dates(data)}
+
+def publish_purchase_changes(changes: List[tuple]):
+    """Publish creations and status changes from (before, after) pairs when change streams are off"""
+    if change_streams_enabled:
+        return
+    for before, after in changes:
+        if before is None:
+            event_broker.publish("purchase", purchase_event_data(after, "created"))
+        elif before.get("status") != after.get("status"):
+            event_broker.publish("purchase", purchase_event_data(after, "status_changed"))
+
+def publish_notifications(notifications: List[dict]):
+    if change_streams_enabled:
+        return
+    for notification in notifications:
+        event_broker.publish("notification", {field: notification.get(field) for field in STREAM_NOTIFICATION_FIELDS})
+
+def change_to_event(change: dict) -> Optional[dict]:
+    document = change.get("fullDocument")
+    if not document:
+        # The purchase was deleted before the update lookup ran
+        return None
+    document.pop("_id", None)
+    event_id = change["_id"]["_data"]
+    if change["ns"]["coll"] == "notifications":
+        return {"id": event_id, "type": "notification", "data": document}
+    operation = "created" if change["operationType"] == "insert" else "status_changed"
+    return {"id": event_id, "type": "purchase", "data": purchase_event_data(document, operation)}
+
+def watch_database(resume_token: Optional[dict] = None):
+    return db.watch(CHANGE_STREAM_PIPELINE, full_document="updateLookup", resume_after=resume_token)
+
+async def follow_change_stream():
+    """Feed the broker from a database change stream, resuming after the last event on errors"""
+    resume_token = None
+    while True:
+        try:
+            async with watch_database(resume_token) as stream:
+                async for change in stream:
+                    resume_token = change["_id"]
+                    event = change_to_event(change)
+                    if event:
+                        event_broker.publish(event["type"], event["data"], event["id"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # InvalidResumeToken, ChangeStreamFatalError, ChangeStreamHistoryLost
+            if isinstance(e, OperationFailure) and e.code in (260, 280, 286):
+                resume_token = None
+                event_broker.publish("reset", {"reason": "history_lost"})
+            logging.error(f"Change stream interrupted: {e}")
+            await asyncio.sleep(STREAM_RETRY_SECONDS)
+
+async def change_stream_backlog(resume_token: str) -> Optional[List[dict]]:
+    """Events after a client's resume token, or None if it can't be resumed or is too far behind"""
+    events = []
+    try:
+        async with watch_database({"_data": resume_token}) as stream:
+            while True:
+                change = await stream.try_next()
+                if change is None:
+                    return events
+                event = change_to_event(change)
+                if event:
+                    events.append(event)
+                if len(events) > STREAM_HISTORY_SIZE:
+                    return None
+    except OperationFailure:
+        return None
+
+async def stream_backlog(last_event_id: Optional[str]) -> List[dict]:
+    if not last_event_id:
+        return []
+    backlog = event_broker.replay_after(last_event_id)
+    if backlog is None and change_streams_enabled:
+        backlog = await change_stream_backlog(last_event_id)
+    if backlog is None:
+        return [stream_reset_event("unknown_event_id")]
+    return backlog
+
+def format_sse(event: dict) -> str:
+    lines = []
+    if event.get("id"):
+        lines.append(f"id: {event['id']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event['data'], separators=(',', ':'), default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+# ==================== Read Cache ====================
+
+class ResponseCache:
+    """LRU of rendered response bodies, bounded by entry count and total size"""
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "collections.OrderedDict[tuple, tuple]" = collections.OrderedDict()
+        self.size = 0
+    
+    def get(self, key: tuple, version: str) -> Optional[tuple]:
+        """(etag, body) cached for key, unless it was rendered at another version"""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1], entry[2]
+    
+    def put(self, key: tuple, version: str, etag: str, body: bytes):
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return
+        self._remove(key)
+        self.entries[key] = (version, etag, body)
+        self.size += len(body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+    
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+    
+    def _remove(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[2])
+
+purchase_read_cache = ResponseCache(PURCHASE_CACHE_ENTRIES, PURCHASE_CACHE_MAX_BYTES)
+
+async def purchases_version() -> str:
+    doc = await db.collection_versions.find_one({"_id": "purchases"})
+    return doc["version"] if doc else "0"
+
+async def purchases_changed():
+    """Invalidate cached purchase reads here and, through the shared version, in other workers"""
+    purchase_read_cache.clear()
+    await db.collection_versions.update_one(
+        {"_id": "purchases"},
+        {"$set": {"version": uuid.uuid4().hex}},
+        upsert=True
+    )
+
+async def purchase_changes_committed(changes: List[tuple]):
+    """Bring counters, live events and read caches in line with stored (before, after) changes"""
+    await apply_stats_changes(changes)
+    publish_purchase_changes(changes)
+    await purchases_changed()
+
+def document_etag(*parts) -> str:
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+async def cached_purchase_read(request: Request, key: tuple, render) -> Response:
+    """
+    Serve a purchase read from the cache while the collection version is unchanged,
+    answering 304 when the client already holds the same representation.
+    render(version) returns (etag, body) for a cache miss.
+    """
+    version = await purchases_version()
+    cached = purchase_read_cache.get(key, version)
+    if cached:
+        etag, body = cached
+    else:
+        etag, body = await render(version)
+        purchase_read_cache.put(key, version, etag, body)
+    
+    # Clients may store responses but must revalidate them on every use
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# ==================== Slow Query Profiler ====================
+
+# Fields the driver adds to commands that explain must not be given
+DRIVER_COMMAND_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+
+# Tasks are referenced until they finish so they aren't garbage collected mid-flight
+slow_query_tasks: set = set()
+# Shape id -> time.monotonic() of the last explain
+last_explained: Dict[str, float] = {}
+
+def query_shape(value):
+    """Replace literal values with their type so queries that differ only in values group together"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(item, (dict, list, tuple)) for item in value):
+            return [query_shape(item) for item in value]
+        return "<list>"
+    return f"<{type(value).__name__}>"
+
+def command_shape(command_name: str, command: dict) -> dict:
+    if command_name == "find":
+        return {"filter": query_shape(command.get("filter", {})), "sort": command.get("sort")}
+    if command_name == "aggregate":
+        return {"pipeline": query_shape(command.get("pipeline", []))}
+    if command_name == "distinct":
+        return {"key": command.get("key"), "query": query_shape(command.get("query", {}))}
+    return {"query": query_shape(command.get("query", {}))}
+
+def summarize_explain(result: dict) -> dict:
+    """Winning plan as a stage chain plus the examined/returned counts"""
+    planner, stats = result.get("queryPlanner"), result.get("executionStats")
+    if planner is None and result.get("stages"):
+        # Aggregations whose first stage runs as a find report it under $cursor
+        cursor_stage = result["stages"][0].get("$cursor", {})
+        planner, stats = cursor_stage.get("queryPlanner"), cursor_stage.get("executionStats")
+    if not planner:
+        return {}
+    
+    node = planner.get("winningPlan", {})
+    # The slot-based engine nests the classic plan tree
+    node = node.get("queryPlan", node)
+    stages = []
+    while node:
+        stage = node.get("stage", "?")
+        if node.get("indexName"):
+            stage += f"({node['indexName']})"
+        stages.append(stage)
+        node = node.get("inputStage") or (node.get("inputStages") or [None])[0]
+    
+    stats = stats or {}
+    return {
+        "plan": " > ".join(stages),
+        "collscan": any(stage == "COLLSCAN" for stage in stages),
+        "keysExamined": stats.get("totalKeysExamined"),
+        "docsExamined": stats.get("totalDocsExamined"),
+        "nReturned": stats.get("nReturned"),
+    }
+
+async def explain_command(database: str, command: dict) -> dict:
+    explainable = {
+        key: value for key, value in command.items()
+        if key not in DRIVER_COMMAND_FIELDS and not key.startswith("$")
+    }
+    try:
+        result = await client[database].command({"explain": explainable, "verbosity": "executionStats"})
+        return summarize_explain(result)
+    except Exception as e:
+        return {"explainError": str(e)}
+
+async def record_slow_query(database: str, command_name: str, command: dict, duration_ms: float):
+    collection = command.get(command_name)
+    if not isinstance(collection, str) or collection == "slow_queries":
+        return
+    shape = f"{collection}.{command_name} {json.dumps(command_shape(command_name, command), sort_keys=True, default=str)}"
+    shape_id = hashlib.sha1(shape.encode("utf-8")).hexdigest()[:16]
+    entry = {
+        "shapeId": shape_id,
+        "shape": shape,
+        "collection": collection,
+        "command": command_name,
+        "durationMs": round(duration_ms, 2),
+        "at": datetime.now(timezone.utc),
+    }
+    now = time.monotonic()
+    if now - last_explained.get(shape_id, float("-inf")) >= SLOW_QUERY_EXPLAIN_INTERVAL:
+        last_explained[shape_id] = now
+        entry.update(await explain_command(database, command))
+    await db.slow_queries.insert_one(entry)
+
+def schedule_slow_query(database: str, command_name: str, command: dict, duration_ms: float):
+    async def run():
+        try:
+            await record_slow_query(database, command_name, command, duration_ms)
+        except Exception as e:
+            logging.warning(f"Could not record slow query: {e}")
+    task = asyncio.create_task(run())
+    slow_query_tasks.add(task)
+    task.add_done_callback(slow_query_tasks.discard)
+
+async def ensure_slow_query_log():
+    """The log is a capped collection so it never needs cleaning up"""
+    if not await db.list_collection_names(filter={"name": "slow_queries"}):
+        await db.create_collection("slow_queries", capped=True, size=SLOW_QUERY_LOG_BYTES)
+
+
+# ==================== Import / Export ====================
+
+# Column layout shared with the frontend CSV export (lib/storage.js). Priority
+# is last because the frontend parser reads columns by position.
+PURCHASE_CSV_COLUMNS = [
+    "ID", "PR_No", "PO_No", "OBR_No", "DV_No", "Title", "Date", "Department", "Purpose", "Status",
+    "Supplier1_Name", "Supplier1_Address", "Supplier2_Name", "Supplier2_Address",
+    "Supplier3_Name", "Supplier3_Address", "Total_Amount", "Items_JSON", "Created_At", "Priority"
+]
+
+def js_numbers(value):
+    """Render integral floats the way JSON.stringify does (2650 rather than 2650.0)"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, list):
+        return [js_numbers(v) for v in value]
+    if isinstance(value, dict):
+        return {k: js_numbers(v) for k, v in value.items()}
+    return value
+
+def purchase_to_csv_row(purchase: dict) -> list:
+    """Inverse of csv_row_to_purchase"""
+    def supplier(n: int, key: str) -> str:
+        return (purchase.get(f"supplier{n}") or {}).get(key) or ""
+    
+    return [
+        purchase.get("id", ""),
+        purchase.get("prNo", ""),
+        purchase.get("poNo", ""),
+        purchase.get("obrNo", ""),
+        purchase.get("dvNo", ""),
+        purchase.get("title", ""),
+        format_date(purchase.get("date")),
+        purchase.get("department", ""),
+        purchase.get("purpose") or "",
+        purchase.get("status", ""),
+        supplier(1, "name"), supplier(1, "address"),
+        supplier(2, "name"), supplier(2, "address"),
+        supplier(3, "name"), supplier(3, "address"),
+        js_numbers(purchase.get("totalAmount", 0)),
+        json.dumps(js_numbers(purchase.get("items", [])), separators=(",", ":")),
+        format_datetime(purchase.get("createdAt")) or "",
+        purchase.get("priority", "")
+    ]
+
+async def stream_purchases_csv(cursor):
+    buffer = io.StringIO()
+    # Header unquoted and every value quoted, as the frontend export writes it
+    buffer.write(",".join(PURCHASE_CSV_COLUMNS) + "\n")
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    rows = 0
+    async for purchase in cursor:
+        writer.writerow(purchase_to_csv_row(purchase))
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def stream_purchases_ndjson(cursor):
+    lines = []
+    async for purchase in cursor:
+        lines.append(json.dumps(format_purchase_dates(purchase), default=str))
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+async def write_purchases_xlsx(cursor) -> str:
+    """Write the CSV layout into a temporary .xlsx file and return its path"""
+    from openpyxl import Workbook
+    
+    # write_only keeps openpyxl from holding every row in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Purchases")
+    sheet.append(PURCHASE_CSV_COLUMNS)
+    async for purchase in cursor:
+        sheet.append(purchase_to_csv_row(purchase))
+    
+    handle, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(handle)
+    await run_in_threadpool(workbook.save, path)
+    return path
+
+async def iter_upload_lines(file: UploadFile):
+    """Yield decoded lines of an upload without reading it into memory at once"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    buffer = ""
+    while True:
+        chunk = await file.read(IMPORT_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += decoder.decode(chunk)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+async def iter_csv_records(file: UploadFile):
+    """Yield parsed CSV records, joining quoted fields that span several lines"""
+    pending = ""
+    async for line in iter_upload_lines(file):
+        pending += line
+        # An odd number of quotes means we are still inside a quoted field
+        if pending.count('"') % 2:
+            continue
+        record, pending = pending.strip(), ""
+        if record:
+            yield next(csv.reader([record]))
+    if pending.strip():
+        yield next(csv.reader([pending.strip()]))
+
+def csv_row_to_purchase(row: Dict[str, str]) -> dict:
+    """Map a row in the PURCHASE_CSV_COLUMNS layout to purchase fields"""
+    def col(name: str) -> str:
+        return (row.get(name) or "").strip()
+    
+    items_json = col("Items_JSON")
+    total_amount = col("Total_Amount")
+    return {
+        "id": col("ID") or None,
+        "prNo": col("PR_No") or None,
+        "poNo": col("PO_No") or None,
+        "obrNo": col("OBR_No") or None,
+        "dvNo": col("DV_No") or None,
+        "title": col("Title"),
+        "date": col("Date"),
+        "department": col("Department"),
+        "purpose": col("Purpose"),
+        # Missing or empty columns are left to the importer's defaults
+        "status": col("Status") or None,
+        "priority": col("Priority") or None,
+        "supplier1": {"name": col("Supplier1_Name"), "address": col("Supplier1_Address")},
+        "supplier2": {"name": col("Supplier2_Name"), "address": col("Supplier2_Address")},
+        "supplier3": {"name": col("Supplier3_Name"), "address": col("Supplier3_Address")},
+        "totalAmount": float(total_amount) if total_amount else 0,
+        "items": json.loads(items_json) if items_json else [],
+        "createdAt": col("Created_At") or None
+    }
+
+# Match keys and document numbers; NDJSON can carry any JSON value here, and e.g.
+# an object would be sent to the database as an operator
+IMPORT_KEY_FIELDS = ("id", *SEQUENCE_FIELDS.values())
+
+def prepare_import_row(raw: dict) -> dict:
+    """Validate one imported record against PurchaseCreate; raises ValidationError, or ValueError naming the field"""
+    for key in IMPORT_KEY_FIELDS:
+        value = raw.get(key)
+        if value is not None and not (isinstance(value, str) and value.strip()):
+            raise ValueError(f"{key}: must be a non-empty string")
+    try:
+        created_at = parse_datetime(raw.get("createdAt"))
+    except ValueError as e:
+        raise ValueError(f"createdAt: {e}")
+    
+    fields = {k: raw[k] for k in PurchaseCreate.model_fields if k != "createdBy" and raw.get(k) is not None}
+    data = store_purchase_dates(price_purchase(PurchaseCreate(**fields).model_dump(exclude={"createdBy"})))
+    # Defaults for fields the record doesn't carry only apply to new purchases,
+    # so importing a file without e.g. a Priority column keeps existing values
+    defaults = {
+        k: data.pop(k) for k in PurchaseCreate.model_fields
+        if k in data and k not in fields and k != "totalAmount"
+    }
+    return {
+        "id": raw.get("id") or str(uuid.uuid4()),
+        "numbers": {field: raw.get(field) for field in SEQUENCE_FIELDS.values()},
+        "createdAt": created_at,
+        "data": data,
+        "defaults": defaults
+    }
+
+async def flush_import_batch(batch: List[dict], imported_by: str, report: ImportReport):
+    """Upsert a batch of prepared rows by id with one unordered bulk_write"""
+    ids = [r["id"] for r in batch]
+    projection = {"_id": 0, "id": 1, "status": 1, "priority": 1, "totalCentavos": 1, "department": 1, "date": 1}
+    existing = {
+        doc["id"]: doc
+        for doc in await db.purchases.find({"id": {"$in": ids}}, projection).to_list(None)
+    }
+    
+    # New purchases without document numbers get them in one reservation per series
+    year = datetime.now().year
+    for prefix, field in SEQUENCE_FIELDS.items():
+        needing = [r for r in batch if not r["numbers"][field] and r["id"] not in existing]
+        if needing:
+            first = await document_sequences.reserve_many(prefix, year, len(needing))
+            for offset, r in enumerate(needing):
+                r["numbers"][field] = generate_id(prefix, year, first + offset)
+    
+    now = utc_now()
+    operations = []
+    audit_entries = []
+    for r in batch:
+        r["set"] = {**r["data"], **{k: v for k, v in r["numbers"].items() if v}}
+        on_insert = {
+            **r["defaults"],
+            "approvalInfo": {"approvedBy": "", "approvedAt": None, "comments": "", "signature": ""},
+            "attachments": [],
+            "createdBy": imported_by
+        }
+        if r["createdAt"]:
+            r["set"]["createdAt"] = r["createdAt"]
+        else:
+            on_insert["createdAt"] = now
+        if r["id"] in existing:
+            r["set"]["updatedAt"] = now
+        
+        operations.append(UpdateOne(
+            {"id": r["id"]},
+            {"$set": r["set"], "$setOnInsert": on_insert},
+            upsert=True
+        ))
+    
+    failed = {}
+    try:
+        await db.purchases.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        failed = {err["index"]: err.get("errmsg", "Write failed") for err in e.details.get("writeErrors", [])}
+    
+    changes = []
+    highest: Dict[tuple, int] = {}
+    for index, r in enumerate(batch):
+        if index in failed:
+            add_import_error(report, r["row"], r["id"], [failed[index]])
+            continue
+        before = existing.get(r["id"])
+        if before:
+            report.updated += 1
+        else:
+            report.inserted += 1
+        changes.append((before, {**(before or r["defaults"]), **r["set"]}))
+        audit_entries.append(audit_document(r["id"], create_audit_entry(
+            "imported", imported_by, f"Purchase request '{r['data']['title']}' imported"
+        )))
+        for value in r["numbers"].values():
+            parsed = parse_document_number(value)
+            if parsed and parsed[0] in SEQUENCE_FIELDS:
+                highest[parsed[:2]] = max(highest.get(parsed[:2], 0), parsed[2])
+    
+    if audit_entries:
+        await db.purchase_audit.insert_many(audit_entries, ordered=False)
+    await apply_stats_changes(changes)
+    publish_purchase_changes(changes)
+    if changes:
+        await purchases_changed()
+    # Imported numbers must not be handed out again by create_purchase
+    for (prefix, year_), number in highest.items():
+        await document_sequences.advance_past(prefix, year_, number)
+
+def add_import_error(report: ImportReport, row: int, purchase_id: Optional[str], errors: List[str]):
+    report.failed += 1
+    if len(report.errors) < IMPORT_MAX_REPORTED_ERRORS:
+        report.errors.append(ImportRowError(row=row, id=purchase_id, errors=errors))
+    else:
+        report.errorsTruncated = True
+
+async def iter_import_records(file: UploadFile, import_format: str):
+    """Yield (row number, raw purchase dict or parse error message) from a CSV or NDJSON upload"""
+    row = 0
+    if import_format == "csv":
+        header = None
+        async for record in iter_csv_records(file):
+            if header is None:
+                header = [h.strip() for h in record]
+                continue
+            row += 1
+            try:
+                yield row, csv_row_to_purchase(dict(zip(header, record)))
+            except ValueError as e:
+                yield row, f"Could not parse row: {e}"
+    else:
+        async for line in iter_upload_lines(file):
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                raw = json.loads(line)
+                yield row, raw if isinstance(raw, dict) else "Each line must be a JSON object"
+            except ValueError as e:
+                yield row, f"Could not parse row: {e}"
+
+
+# ==================== API Routes ====================
+
+@api_router.get("/")
+async def root():
+    return {"message": "MDRRMO Procurement System API", "version": "2.0"}
+
+# Create new purchase
+@api_router.post("/purchases", response_model=Purchase)
+async def create_purchase(purchase_data: PurchaseCreate):
+    try:
+        # Generate IDs; each series resets when the year changes
+        year = datetime.now().year
+        numbers = await asyncio.gather(
+            *(document_sequences.next(prefix, year) for prefix in SEQUENCE_FIELDS)
+        )
+        
+        purchase_dict = store_purchase_dates(price_purchase(purchase_data.model_dump()))
+        purchase_dict["id"] = str(uuid.uuid4())
+        for (prefix, field), number in zip(SEQUENCE_FIELDS.items(), numbers):
+            purchase_dict[field] = generate_id(prefix, year, number)
+        purchase_dict["createdAt"] = utc_now()
+        
+        # Initialize new fields
+        purchase_dict["approvalInfo"] = {"approvedBy": "", "approvedAt": None, "comments": "", "signature": ""}
+        purchase_dict["attachments"] = []
+        
+        # Insert a copy so insert_one's generated _id stays out of the response
+        async def insert(session):
+            await db.purchases.insert_one({**purchase_dict}, session=session)
+            return purchase_dict
+        
+        async def audit(session, purchase):
+            await append_audit(
+                purchase["id"],
+                create_audit_entry("created", purchase_data.createdBy, f"Purchase request '{purchase_data.title}' created"),
+                session
+            )
+        
+        # Create notification for new purchase
+        async def notify(session, purchase):
+            await create_notification_internal(
+                "purchase_created",
+                "New Purchase Request",
+                f"Purchase request '{purchase_data.title}' has been created and is pending approval.",
+                purchase["id"],
+                session
+            )
+        
+        async def committed(purchase):
+            await purchase_changes_committed([(None, purchase)])
+        
+        await run_purchase_write(insert, audit, notify, committed=committed)
+        
+        return Purchase(**format_purchase_dates({**purchase_dict}))
+    
+    except Exception as e:
+        logging.error(f"Error creating purchase: {e}")
+        raise HTTPException(status_code=500, detail=f"Error creating purchase: {str(e)}")
+
+async def search_purchases_page(query: dict, projection: Optional[dict], limit: int, cursor: Optional[str]) -> ORJSONResponse:
+    """Relevance-ranked page of text search results"""
+    # Text scores can't be used in a filter, so search pages by offset instead of by key
+    offset = decode_cursor(cursor, ("offset",))["offset"] if cursor else 0
+    score = {"$meta": "textScore"}
+    find_cursor = db.purchases.find(query, {**(projection or PURCHASE_PROJECTION), "score": score}) \
+        .sort([("score", score), ("createdAt", -1), ("id", -1)]) \
+        .skip(offset) \
+        .limit(limit + 1)
+    if cursor:
+        purchases, total = await find_cursor.to_list(limit + 1), None
+    else:
+        purchases, total = await asyncio.gather(find_cursor.to_list(limit + 1), db.purchases.count_documents(query))
+    
+    has_more = len(purchases) > limit
+    purchases = purchases[:limit]
+    for p in purchases:
+        p.pop("score", None)
+    
+    items = [format_purchase_dates(p) for p in purchases] if projection else [trusted_purchase(p) for p in purchases]
+    return purchase_page_response(
+        items,
+        total,
+        has_more,
+        encode_cursor({"offset": offset + limit}, ("offset",)) if has_more else None
+    )
+
+# Get purchases with optional filtering, keyset pagination and field projection
+@api_router.get("/purchases", response_model=PurchasePage)
+async def get_purchases(
+    request: Request,
+    status: Optional[str] = Query(None, description="Filter by status"),
+    priority: Optional[str] = Query(None, description="Filter by priority"),
+    department: Optional[str] = Query(None, description="Filter by department"),
+    date_from: Optional[str] = Query(None, description="Filter by start date"),
+    date_to: Optional[str] = Query(None, description="Filter by end date"),
+    min_amount: Optional[float] = Query(None, description="Filter by minimum amount"),
+    max_amount: Optional[float] = Query(None, description="Filter by maximum amount"),
+    search: Optional[str] = Query(None, description="Text search, or the start of a document number such as 2025-PR-01, PR-001 or 001"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+    cursor: Optional[str] = Query(None, description="Cursor returned as nextCursor by the previous page"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. prNo,title,status")
+):
+    try:
+        search = search.strip() if search else None
+        query = build_purchase_query(
+            status, priority, department, date_from, date_to, min_amount, max_amount, search
+        )
+        projection = parse_fields(fields)
+        
+        async def render(version: str) -> tuple:
+            if "$text" in query:
+                page = await search_purchases_page(query, projection, limit, cursor)
+                return f'W/"{version}"', page.body
+            
+            # Newest first; id breaks ties between purchases created in the same instant
+            page_query = query
+            if cursor:
+                after = decode_cursor(cursor)
+                page_query = {
+                    "$and": [
+                        query,
+                        {"$or": [
+                            {"createdAt": {"$lt": after["createdAt"]}},
+                            {"createdAt": after["createdAt"], "id": {"$lt": after["id"]}}
+                        ]}
+                    ]
+                }
+            
+            # Fetch one extra document to learn whether another page exists
+            find_cursor = db.purchases.find(page_query, projection or PURCHASE_PROJECTION) \
+                .sort([("createdAt", -1), ("id", -1)]) \
+                .limit(limit + 1)
+            # Clients keep the first page's total, so cursor pages skip the count
+            if cursor:
+                purchases, total = await find_cursor.to_list(limit + 1), None
+            else:
+                purchases, total = await asyncio.gather(find_cursor.to_list(limit + 1), count_purchases(query))
+            
+            has_more = len(purchases) > limit
+            purchases = purchases[:limit]
+            
+            # Copies, since the cursor below needs the stored createdAt
+            items = [format_purchase_dates({**p}) for p in purchases] if projection else [trusted_purchase(p) for p in purchases]
+            page = purchase_page_response(
+                items,
+                total,
+                has_more,
+                encode_cursor(purchases[-1]) if has_more else None
+            )
+            return f'W/"{version}"', page.body
+        
+        # The same filters in any order or spelling share one cache entry
+        key = (
+            "list", status, priority, department, date_from, date_to, min_amount, max_amount,
+            search, limit, cursor, tuple(sorted(projection)) if projection else None
+        )
+        return await cached_purchase_read(request, key, render)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching purchases: {e}")
+        raise HTTPException(status_code=500, detail=f"Error fetching purchases: {str(e)}")
+
+# Export purchases matching the list filters as CSV (export layout), NDJSON or XLSX
+@api_router.get("/purchases/export")
+async def export_purchases(
+    format: str = Query("csv", pattern="^(csv|ndjson|xlsx)$", description="csv, ndjson or xlsx"),
+    status: Optional[str] = Query(None, description="Filter by status"),
+    priority: Optional[str] = Query(None, description="Filter by priority"),
+    department: Optional[str] = Query(None, description="Filter by department"),
+    date_from: Optional[str] = Query(None, description="Filter by start date"),
+    date_to: Optional[str] = Query(None, description="Filter by end date"),
+    min_amount: Optional[float] = Query(None, description="Filter by minimum amount"),
+    max_amount: Optional[float] = Query(None, description="Filter by maximum amount"),
+    search: Optional[str] = Query(None, description="Text search, or the start of a document number such as 2025-PR-01, PR-001 or 001")
+):
+    try:
+        query = build_purchase_query(
+            status, priority, department, date_from, date_to, min_amount, max_amount, search
+        )
+        # History and attachments don't round-trip through import, so they aren't exported
+        cursor = db.purchases.find(query, {"_id": 0, "auditTrail": 0, "attachments": 0}) \
+            .sort([("createdAt", -1), ("id", -1)]) \
+            .batch_size(EXPORT_BATCH_SIZE)
+        filename = f"purchases-{datetime.now().strftime('%Y%m%d')}.{format}"
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+        
+        if format == "csv":
+            return StreamingResponse(stream_purchases_csv(cursor), media_type="text/csv", headers=headers)
+        if format == "ndjson":
+            return StreamingResponse(stream_purchases_ndjson(cursor), media_type="application/x-ndjson", headers=headers)
+        
+        path = await write_purchases_xlsx(cursor)
+        return FileResponse(
+            path=path,
+            filename=filename,
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            background=BackgroundTask(os.unlink, path)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error exporting purchases: {e}")
+        raise HTTPException(status_code=500, detail=f"Error exporting purchases: {str(e)}")
+
+# Bulk import purchases from a CSV (export layout) or NDJSON upload, upserting by id
+@api_router.post("/purchases/import", response_model=ImportReport)
+async def import_purchases(
+    file: UploadFile = File(...),
+    format: Optional[str] = Form(None),
+    imported_by: str = Form("System")
+):
+    try:
+        import_format = (format or Path(file.filename or "").suffix.lstrip(".")).lower()
+        if import_format in ("jsonl", "json"):
+            import_format = "ndjson"
+        if import_format not in ("csv", "ndjson"):
+            raise HTTPException(status_code=400, detail="Unsupported import format. Use csv or ndjson")
+        
+        report = ImportReport()
+        batch: List[dict] = []
+        batch_ids: set = set()
+        async for row, raw in iter_import_records(file, import_format):
+            report.processed += 1
+            if isinstance(raw, str):
+                add_import_error(report, row, None, [raw])
+                continue
+            raw_id = raw.get("id") if isinstance(raw.get("id"), str) else None
+            try:
+                prepared = prepare_import_row(raw)
+            except ValidationError as e:
+                add_import_error(report, row, raw_id, [
+                    f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors()
+                ])
+                continue
+            except ValueError as e:
+                add_import_error(report, row, raw_id, [str(e)])
+                continue
+            prepared["row"] = row
+            
+            # A repeated id must see the previous row's write as its pre-image
+            if prepared["id"] in batch_ids or len(batch) >= IMPORT_BATCH_SIZE:
+                await flush_import_batch(batch, imported_by, report)
+                batch, batch_ids = [], set()
+            batch.append(prepared)
+            batch_ids.add(prepared["id"])
+        
+        if batch:
+            await flush_import_batch(batch, imported_by, report)
+        
+        if report.inserted or report.updated:
+            await create_notification_internal(
+                "purchases_imported",
+                "Purchases Imported",
+                f"{report.inserted} purchase(s) created and {report.updated} updated from '{file.filename}'."
+            )
+        
+        return report
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error importing purchases: {e}")
+        raise HTTPException(status_code=500, detail=f"Error importing purchases: {str(e)}")
+
+# Get single purchase by ID
+@api_router.get("/purchases/{purchase_id}", response_model=Purchase)
+async def get_purchase(purchase_id: str, request: Request):
+    try:
+        async def render(version: str) -> tuple:
+            purchase = await db.purchases.find_one({"id": purchase_id}, PURCHASE_PROJECTION)
+            if not purchase:
+                raise HTTPException(status_code=404, detail="Purchase not found")
+            # Every write to a purchase sets updatedAt, so unrelated writes keep its ETag
+            etag = document_etag(purchase_id, purchase.get("updatedAt") or purchase.get("createdAt"))
+            return etag, ORJSONResponse(trusted_purchase(purchase)).body
+        
+        return await cached_purchase_read(request, ("get", purchase_id), render)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching purchase: {e}")
+        raise HTTPException(status_code=500, detail=f"Error fetching purchase: {str(e)}")
+
+# Update purchase
+@api_router.put("/purchases/{purchase_id}", response_model=Purchase)
+async def update_purchase(purchase_id: str, purchase_data: PurchaseCreate):
+    try:
+        update_dict = store_purchase_dates(price_purchase(purchase_data.model_dump()))
+        update_dict["updatedAt"] = utc_now()
+        
+        # One round trip: apply the update and get the pre-image for the audit diff
+        async def write(session):
+            return await db.purchases.find_one_and_update(
+                {"id": purchase_id},
+                {"$set": update_dict},
+                return_document=ReturnDocument.BEFORE,
+                session=session
+            )
+        
+        # Add audit trail entry
+        async def audit(session, existing):
+            changes = []
+            if existing.get("title") != update_dict.get("title"):
+                changes.append(f"Title changed from '{existing.get('title')}' to '{update_dict.get('title')}'")
+            if existing.get("totalAmount") != update_dict.get("totalAmount"):
+                changes.append(f"Amount changed from {existing.get('totalAmount')} to {update_dict.get('totalAmount')}")
+            if existing.get("status") != update_dict.get("status"):
+                changes.append(f"Status changed from '{existing.get('status')}' to '{update_dict.get('status')}'")
+            
+            audit_entry = create_audit_entry(
+                "updated",
+                purchase_data.createdBy,
+                "; ".join(changes) if changes else "Purchase details updated"
+            )
+            await append_audit(purchase_id, audit_entry, session)
+        
+        async def committed(existing):
+            existing.pop("_id", None)
+            # $set only replaces top-level fields, so the post-image is an exact merge
+            await purchase_changes_committed([(existing, {**existing, **update_dict})])
+        
+        existing = await run_purchase_write(write, audit, committed=committed)
+        if not existing:
+            raise HTTPException(status_code=404, detail="Purchase not found")
+        updated = {**existing, **update_dict}
+        
+        return Purchase(**format_purchase_dates({**updated}))
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error updating purchase: {e}")
+        raise HTTPException(status_code=500, detail=f"Error updating purchase: {str(e)}")
+
+def status_update_fields(new_status: str, comments: str, approved_by: str) -> dict:
+    update_data = {
+        "status": new_status,
+        "updatedAt": utc_now()
+    }
+    
+    # If approved or denied, update approval info
+    if new_status in ["Approved", "Denied"]:
+        update_data["approvalInfo"] = {
+            "approvedBy": approved_by or "System",
+            "approvedAt": datetime.now(timezone.utc).isoformat(),
+            "comments": comments,
+            "signature": ""
+        }
+    return update_data
+
+def status_audit_entry(old_status: str, new_status: str, comments: str, approved_by: str) -> dict:
+    action = "status_changed"
+    if new_status == "Approved":
+        action = "approved"
+    elif new_status == "Denied":
+        action = "denied"
+    
+    return create_audit_entry(
+        action,
+        approved_by or "System",
+        comments or f"Status changed from {old_status} to {new_status}",
+        old_status,
+        new_status
+    )
+
+def status_notification(purchase: dict, new_status: str, comments: str) -> dict:
+    message = f"Purchase request '{purchase.get('title')}' has been {new_status.lower()}."
+    if comments:
+        message += f" Comment: {comments}"
+    return new_notification("status_changed", f"Purchase {new_status}", message, purchase["id"])
+
+# Change the status of many purchases in one request
+@api_router.patch("/purchases/status:batch", response_model=BatchStatusResponse)
+async def update_purchase_status_batch(batch: BatchStatusUpdate):
+    """
+    Apply one status to many purchases. Each purchase reports whether it was
+    updated, was already in that status, doesn't exist, or changed status
+    concurrently (conflict).
+    """
+    try:
+        new_status = batch.status
+        projection = {"_id": 0, "id": 1, "prNo": 1, "title": 1, "status": 1, "priority": 1,
+                      "totalCentavos": 1, "department": 1, "date": 1}
+        existing = {
+            doc["id"]: doc
+            for doc in await db.purchases.find({"id": {"$in": batch.ids}}, projection).to_list(None)
+        }
+        
+        results = {}
+        candidates = []
+        for purchase_id in batch.ids:
+            purchase = existing.get(purchase_id)
+            if purchase is None:
+                results[purchase_id] = BatchStatusResult(id=purchase_id, result="not_found")
+            elif purchase.get("status") == new_status:
+                results[purchase_id] = BatchStatusResult(id=purchase_id, result="unchanged", previousStatus=new_status)
+            else:
+                candidates.append(purchase)
+        
+        update_data = status_update_fields(new_status, batch.comments, batch.approvedBy)
+        
+        # Each update only applies if the status is still the one read above
+        async def write(session):
+            if not candidates:
+                return None
+            result = await db.purchases.bulk_write(
+                [UpdateOne({"id": p["id"], "status": p.get("status")}, {"$set": update_data}) for p in candidates],
+                ordered=False,
+                session=session
+            )
+            if result.matched_count == len(candidates):
+                return candidates
+            # Some purchases changed in between; ours are the ones carrying this exact update
+            applied = {
+                doc["id"]
+                for doc in await db.purchases.find(
+                    {"id": {"$in": [p["id"] for p in candidates]}, "status": new_status, "updatedAt": update_data["updatedAt"]},
+                    {"_id": 0, "id": 1},
+                    session=session
+                ).to_list(None)
+            }
+            return [p for p in candidates if p["id"] in applied] or None
+        
+        async def audit(session, applied):
+            await db.purchase_audit.insert_many(
+                [
+                    audit_document(p["id"], status_audit_entry(p.get("status", "Pending"), new_status, batch.comments, batch.approvedBy))
+                    for p in applied
+                ],
+                session=session
+            )
+        
+        async def notify(session, applied):
+            await enqueue_notifications(
+                [status_notification(p, new_status, batch.comments) for p in applied],
+                session=session
+            )
+        
+        async def committed(applied):
+            await purchase_changes_committed([(purchase, {**purchase, **update_data}) for purchase in applied])
+        
+        applied = await run_purchase_write(write, audit, notify, committed=committed) or []
+        for purchase in applied:
+            results[purchase["id"]] = BatchStatusResult(
+                id=purchase["id"], result="updated", previousStatus=purchase.get("status")
+            )
+        for purchase in candidates:
+            results.setdefault(
+                purchase["id"],
+                BatchStatusResult(id=purchase["id"], result="conflict", previousStatus=purchase.get("status"))
+            )
+        
+        return BatchStatusResponse(
+            status=new_status,
+            updated=len(applied),
+            results=[results[purchase_id] for purchase_id in batch.ids]
+        )
+    
+    except Exception as e:
+        logging.error(f"Error updating statuses: {e}")
+        raise HTTPException(status_code=500, detail=f"Error updating statuses: {str(e)}")
+
+# Update purchase status with approval workflow
+@api_router.patch("/purchases/{purchase_id}/status", response_model=Purchase)
+async def update_purchase_status(purchase_id: str, status_update: StatusUpdate):
+    try:
+        new_status = status_update.status
+        update_data = status_update_fields(new_status, status_update.comments, status_update.approvedBy)
+        
+        # Update status, keeping the pre-image for the audit entry and counters
+        async def write(session):
+            return await db.purchases.find_one_and_update(
+                {"id": purchase_id},
+                {"$set": update_data},
+                return_document=ReturnDocument.BEFORE,
+                session=session
+            )
+        
+        # Create audit entry
+        async def audit(session, existing):
+            audit_entry = status_audit_entry(
+                existing.get("status", "Pending"), new_status, status_update.comments, status_update.approvedBy
+            )
+            await append_audit(purchase_id, audit_entry, session)
+        
+        # Create notification
+        async def notify(session, existing):
+            await enqueue_notification(status_notification(existing, new_status, status_update.comments), session)
+        
+        async def committed(existing):
+            existing.pop("_id", None)
+            await purchase_changes_committed([(existing, {**existing, **update_data})])
+        
+        existing = await run_purchase_write(write, audit, notify, committed=committed)
+        if not existing:
+            raise HTTPException(status_code=404, detail="Purchase not found")
+        updated = {**existing, **update_data}
+        
+        return Purchase(**format_purchase_dates({**updated}))
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error updating status: {e}")
+        raise HTTPException(status_code=500, detail=f"Error updating status: {str(e)}")
+
+# Delete purchase
+@api_router.delete("/purchases/{purchase_id}")
+async def delete_purchase(purchase_id: str):
+    try:
+        deleted = await db.purchases.find_one_and_delete({"id": purchase_id})
+        if not deleted:
+            raise HTTPException(status_code=404, detail="Purchase not found")
+        await apply_stats_change(deleted, None)
+        await purchases_changed()
+        for attachment in deleted.get("attachments", []):
+            await release_attachment_file(attachment)
+        return {"message": "Purchase deleted successfully", "id": purchase_id}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error deleting purchase: {e}")
+        raise HTTPException(status_code=500, detail=f"Error deleting purchase: {str(e)}")
+
+# Get dashboard statistics
+@api_router.get("/purchases/stats/dashboard", response_model=DashboardStats)
+async def get_dashboard_stats(
+    date_from: Optional[str] = Query(None, description="Only count purchases dated on or after"),
+    date_to: Optional[str] = Query(None, description="Only count purchases dated on or before"),
+    department: Optional[str] = Query(None, description="Only count purchases of this department")
+):
+    try:
+        # Scoped stats can't come from the counters, so they are aggregated on demand
+        if date_from or date_to or department:
+            match = build_purchase_query(department=department, date_from=date_from, date_to=date_to)
+            return dashboard_stats_response(await compute_dashboard_stats(match))
+        
+        # recentActivity is a sliding window, so it is counted over the createdAt index
+        seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
+        stats, recent_count = await asyncio.gather(
+            read_materialized_stats(),
+            db.purchases.count_documents({"createdAt": {"$gte": seven_days_ago}})
+        )
+        if stats is None:
+            stats = await rebuild_dashboard_stats()
+        stats["recentActivity"] = recent_count
+        
+        return dashboard_stats_response(stats)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Error fetching stats: {str(e)}")
+
+
+# ==================== Notification Outbox ====================
+
+class NotificationSink:
+    """
+    Delivery target for outbox notifications.
+    
+    deliver() receives a batch of notification dicts and raises to have the whole
+    batch retried later, so it must tolerate seeing the same notification id twice.
+    """
+    name = "sink"
+    
+    async def deliver(self, notifications: List[dict]):
+        raise NotImplementedError
+
+# Counter behind the inbox delivery order. Read watermarks compare seq rather than
+# createdAt, which is set at enqueue time: a retried entry can land long after
+# newer ones and must not count as read by a mark-all that happened before it.
+NOTIFICATION_SEQUENCE_ID = "notifications"
+
+async def reserve_notification_seqs(count: int) -> int:
+    """Claim count consecutive delivery numbers and return the first"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": NOTIFICATION_SEQUENCE_ID},
+        {"$inc": {"value": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["value"] - count + 1
+
+class InboxSink(NotificationSink):
+    """In-app notifications served by /api/notifications"""
+    name = "inbox"
+    
+    async def deliver(self, notifications: List[dict]):
+        expires_at = datetime.now(timezone.utc) + timedelta(days=NOTIFICATION_RETENTION_DAYS)
+        # Redeliveries leave gaps in the sequence, which is harmless
+        first_seq = await reserve_notification_seqs(len(notifications))
+        result = await db.notifications.bulk_write([
+            UpdateOne({"id": n["id"]}, {"$setOnInsert": {**n, "seq": first_seq + index, "expiresAt": expires_at}}, upsert=True)
+            for index, n in enumerate(notifications)
+        ], ordered=False)
+        # Redeliveries match the existing document and aren't announced twice
+        publish_notifications([notifications[index] for index in sorted(result.upserted_ids)])
+
+class LogSink(NotificationSink):
+    """Writes notifications to the application log; a stand-in for email/SMS in development"""
+    name = "log"
+    
+    async def deliver(self, notifications: List[dict]):
+        for n in notifications:
+            logging.info(f"Notification [{n['type']}] {n['title']}: {n['message']}")
+
+class MemorySink(NotificationSink):
+    """Keeps delivered notifications in memory for tests"""
+    name = "memory"
+    
+    def __init__(self):
+        self.delivered: List[dict] = []
+    
+    async def deliver(self, notifications: List[dict]):
+        self.delivered.extend(notifications)
+
+NOTIFICATION_SINK_TYPES = {sink.name: sink for sink in (InboxSink, LogSink, MemorySink)}
+
+notification_sinks: List[NotificationSink] = [
+    NOTIFICATION_SINK_TYPES[name.strip()]()
+    for name in NOTIFICATION_SINKS.split(",") if name.strip()
+]
+
+def register_notification_sink(sink: NotificationSink):
+    """Add a delivery target; entries already delivered elsewhere are not replayed to it"""
+    if any(existing.name == sink.name for existing in notification_sinks):
+        raise ValueError(f"Notification sink '{sink.name}' is already registered")
+    notification_sinks.append(sink)
+
+# Set whenever something is enqueued so the worker doesn't wait for the next poll
+outbox_wakeup = asyncio.Event()
+
+def notification_dedupe_key(notification: dict) -> str:
+    raw = "|".join(str(notification.get(k) or "") for k in ("type", "purchaseId", "title", "message"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def outbox_backoff(attempts: int) -> timedelta:
+    """Exponential backoff with jitter so failing sinks aren't hammered in lockstep"""
+    delay = min(OUTBOX_MAX_BACKOFF_SECONDS, OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+async def enqueue_notification(notification: dict, session=None):
+    """
+    Queue a notification for delivery. An identical notification that is still
+    waiting for delivery absorbs this one instead of producing a second copy.
+    """
+    await enqueue_notifications([notification], session=session)
+
+async def enqueue_notifications(notifications: List[dict], session=None):
+    """Queue many notifications with one bulk write, deduplicated like enqueue_notification"""
+    if not notifications:
+        return
+    now = datetime.now(timezone.utc)
+    # Ordered, so two notifications with the same key in one batch collapse into one entry
+    await db.notification_outbox.bulk_write([
+        UpdateOne(
+            {"dedupeKey": notification_dedupe_key(notification), "status": "pending"},
+            {"$setOnInsert": {
+                "id": notification["id"],
+                "notification": notification,
+                "attempts": 0,
+                "delivered": [],
+                "nextAttemptAt": now,
+                "createdAt": now,
+            }},
+            upsert=True
+        )
+        for notification in notifications
+    ], session=session)
+    outbox_wakeup.set()
+
+async def drain_outbox_once() -> int:
+    """Claim one batch of due outbox entries, deliver it to every sink and record the outcome"""
+    now = datetime.now(timezone.utc)
+    lease = str(uuid.uuid4())
+    claimable = {
+        "status": "pending",
+        "nextAttemptAt": {"$lte": now},
+        "$or": [{"leaseUntil": None}, {"leaseUntil": {"$lt": now}}],
+    }
+    due = await db.notification_outbox.find(claimable, {"_id": 0, "id": 1}).sort(
+        "nextAttemptAt", ASCENDING
+    ).limit(OUTBOX_BATCH_SIZE).to_list(OUTBOX_BATCH_SIZE)
+    if not due:
+        return 0
+    
+    # Another worker may claim some of the same entries; the lease decides who won
+    await db.notification_outbox.update_many(
+        {**claimable, "id": {"$in": [d["id"] for d in due]}},
+        {"$set": {"lease": lease, "leaseUntil": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)}}
+    )
+    entries = await db.notification_outbox.find({"lease": lease}, {"_id": 0}).to_list(None)
+    
+    # Concurrent enqueues can race past the upsert filter; deliver one per key
+    unique, duplicates = {}, []
+    for entry in entries:
+        if entry["dedupeKey"] in unique:
+            duplicates.append(entry)
+        else:
+            unique[entry["dedupeKey"]] = entry
+    batch = list(unique.values())
+    
+    delivered = {entry["id"]: set(entry.get("delivered", [])) for entry in batch}
+    errors: Dict[str, str] = {}
+    for sink in notification_sinks:
+        pending = [entry for entry in batch if sink.name not in delivered[entry["id"]]]
+        if not pending:
+            continue
+        try:
+            await sink.deliver([entry["notification"] for entry in pending])
+            for entry in pending:
+                delivered[entry["id"]].add(sink.name)
+        except Exception as e:
+            logging.warning(f"Notification sink '{sink.name}' failed for {len(pending)} entries: {e}")
+            for entry in pending:
+                errors[entry["id"]] = f"{sink.name}: {e}"
+    
+    release = {"$unset": {"lease": "", "leaseUntil": ""}}
+    ops = [
+        UpdateOne({"id": entry["id"], "lease": lease}, {"$set": {"status": "duplicate", "deliveredAt": now}, **release})
+        for entry in duplicates
+    ]
+    for entry in batch:
+        entry_id = entry["id"]
+        if entry_id not in errors:
+            update = {"status": "delivered", "delivered": sorted(delivered[entry_id]), "deliveredAt": now}
+        else:
+            attempts = entry.get("attempts", 0) + 1
+            update = {
+                "status": "failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending",
+                "delivered": sorted(delivered[entry_id]),
+                "attempts": attempts,
+                "lastError": errors[entry_id],
+                "nextAttemptAt": now + outbox_backoff(attempts),
+            }
+        ops.append(UpdateOne({"id": entry_id, "lease": lease}, {"$set": update, **release}))
+    await db.notification_outbox.bulk_write(ops, ordered=False)
+    return len(entries)
+
+async def run_outbox_worker():
+    while True:
+        outbox_wakeup.clear()
+        try:
+            drained = await drain_outbox_once()
+        except Exception as e:
+            logging.error(f"Notification outbox worker failed: {e}")
+            drained = 0
+        if drained >= OUTBOX_BATCH_SIZE:
+            continue
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+# ==================== Notifications API ====================
+
+def new_notification(type: str, title: str, message: str, purchase_id: str = None) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "type": type,
+        "title": title,
+        "message": message,
+        "purchaseId": purchase_id,
+        "createdAt": datetime.now(timezone.utc).isoformat()
+    }
+
+async def create_notification_internal(type: str, title: str, message: str, purchase_id: str = None, session=None):
+    """Internal helper to create notification; delivery happens in the outbox worker"""
+    notification = new_notification(type, title, message, purchase_id)
+    await enqueue_notification(notification, session=session)
+    return notification
+
+# Read state is kept per user as a watermark: everything delivered at or before
+# seq readThrough is read, plus the notifications in readIds, which are always
+# newer than readThrough. Users without a document of their own inherit the shared default.
+DEFAULT_READ_STATE_ID = "*"
+
+async def get_read_state(user: str) -> dict:
+    states = {
+        state["_id"]: state
+        for state in await db.notification_reads.find({"_id": {"$in": [user, DEFAULT_READ_STATE_ID]}}).to_list(2)
+    }
+    state = states.get(user) or states.get(DEFAULT_READ_STATE_ID) or {}
+    return {
+        "readThrough": state.get("readThrough", 0),
+        "readIds": state.get("readIds", []),
+        "inherited": user not in states,
+    }
+
+async def own_read_state(user: str, state: dict):
+    """Give the user a document of their own, seeded from the state they inherited"""
+    if not state["inherited"]:
+        return
+    try:
+        await db.notification_reads.insert_one(
+            {"_id": user, "readThrough": state["readThrough"], "readIds": state["readIds"]}
+        )
+    except DuplicateKeyError:
+        pass
+
+def read_notification_ids(state: dict) -> List[str]:
+    return [entry["id"] for entry in state["readIds"]]
+
+def unread_query(state: dict) -> dict:
+    query = {"seq": {"$gt": state["readThrough"]}}
+    if state["readIds"]:
+        query["id"] = {"$nin": read_notification_ids(state)}
+    return query
+
+@api_router.get("/notifications", response_model=NotificationPage)
+async def get_notifications(
+    user: str = Query("System", description="Whose read state to apply"),
+    unread_only: bool = Query(False),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+    cursor: Optional[str] = Query(None, description="Cursor returned as nextCursor by the previous page")
+):
+    try:
+        state = await get_read_state(user)
+        query = unread_query(state) if unread_only else {}
+        if cursor:
+            after = decode_cursor(cursor)
+            query = {
+                "$and": [
+                    query,
+                    {"$or": [
+                        {"createdAt": {"$lt": after["createdAt"]}},
+                        {"createdAt": after["createdAt"], "id": {"$lt": after["id"]}}
+                    ]}
+                ]
+            }
+        
+        notifications = await db.notifications.find(query, {"_id": 0, "expiresAt": 0}) \
+            .sort([("createdAt", -1), ("id", -1)]) \
+            .limit(limit + 1) \
+            .to_list(limit + 1)
+        has_more = len(notifications) > limit
+        notifications = notifications[:limit]
+        
+        read_ids = set(read_notification_ids(state))
+        items = [
+            Notification(**{**n, "read": n["seq"] <= state["readThrough"] or n["id"] in read_ids})
+            for n in notifications
+        ]
+        return NotificationPage(
+            items=items,
+            hasMore=has_more,
+            nextCursor=encode_cursor(notifications[-1]) if has_more else None
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching notifications: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/notifications/unread-count")
+async def get_unread_notification_count(user: str = Query("System")):
+    try:
+        state = await get_read_state(user)
+        # Both counts are answered from the seq and id indexes without fetching documents
+        newer = db.notifications.count_documents({"seq": {"$gt": state["readThrough"]}})
+        if not state["readIds"]:
+            return {"unread": await newer}
+        newer, read_individually = await asyncio.gather(
+            newer,
+            db.notifications.count_documents({"id": {"$in": read_notification_ids(state)}})
+        )
+        return {"unread": max(newer - read_individually, 0)}
+    except Exception as e:
+        logging.error(f"Error counting unread notifications: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @api_router.post("/notifications", response_model=Notification)
 async def create_notification(notification_data: NotificationCreate):
     try:
@@ -516,14 +2831,20 @@ async def create_notification(notification_data: NotificationCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.patch("/notifications/{notification_id}/read")
-async def mark_notification_read(notification_id: str):
+async def mark_notification_read(notification_id: str, user: str = Query("System")):
     try:
-        result = await db.notifications.update_one(
-            {"id": notification_id},
-            {"$set": {"read": True}}
+        notification, state = await asyncio.gather(
+            db.notifications.find_one({"id": notification_id}, {"_id": 0, "seq": 1}),
+            get_read_state(user)
         )
-        if result.modified_count == 0:
+        if not notification:
             raise HTTPException(status_code=404, detail="Notification not found")
+        if notification["seq"] > state["readThrough"]:
+            await own_read_state(user, state)
+            await db.notification_reads.update_one(
+                {"_id": user},
+                {"$addToSet": {"readIds": {"id": notification_id, "seq": notification["seq"]}}}
+            )
         return {"message": "Notification marked as read"}
     except HTTPException:
         raise
@@ -532,14 +2853,101 @@ async def mark_notification_read(notification_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.patch("/notifications/mark-all-read")
-async def mark_all_notifications_read():
+async def mark_all_notifications_read(
+    user: str = Query("System"),
+    through: Optional[int] = Query(None, description="seq of the newest notification the user has seen; defaults to the newest one delivered")
+):
     try:
-        await db.notifications.update_many({"read": False}, {"$set": {"read": True}})
+        if through is None:
+            newest = await db.notifications.find_one({}, {"_id": 0, "seq": 1}, sort=[("seq", -1)])
+            if not newest:
+                return {"message": "All notifications marked as read"}
+            through = newest["seq"]
+        await own_read_state(user, await get_read_state(user))
+        # One document update however many notifications there are; entries the
+        # watermark now covers are dropped, and it never moves backwards
+        await db.notification_reads.update_one(
+            {"_id": user},
+            {"$max": {"readThrough": through}, "$pull": {"readIds": {"seq": {"$lte": through}}}}
+        )
         return {"message": "All notifications marked as read"}
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error marking all notifications read: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+NOTIFICATION_MIGRATION_BATCH_SIZE = 500
+
+async def migrate_legacy_notifications() -> dict:
+    """
+    Number notifications stored before delivery sequencing, fold the old global
+    read flag into the default read state and give notifications stored before
+    retention was introduced an expiry
+    """
+    report = {"sequenced": 0, "readFlags": 0, "expiries": 0}
+    
+    # Numbered oldest first, so the delivery order follows the creation order
+    unsequenced = await db.notifications.count_documents({"seq": {"$exists": False}})
+    if unsequenced:
+        next_seq = await reserve_notification_seqs(unsequenced)
+        operations = []
+        async for n in db.notifications.find({"seq": {"$exists": False}}, {"_id": 0, "id": 1}) \
+                .sort([("createdAt", 1), ("id", 1)]):
+            # Stop at the reserved block; anything left over is numbered by the next run
+            if len(operations) + report["sequenced"] >= unsequenced:
+                break
+            operations.append(UpdateOne({"id": n["id"], "seq": {"$exists": False}}, {"$set": {"seq": next_seq}}))
+            next_seq += 1
+            if len(operations) >= NOTIFICATION_MIGRATION_BATCH_SIZE:
+                await db.notifications.bulk_write(operations, ordered=False)
+                report["sequenced"] += len(operations)
+                operations = []
+        if operations:
+            await db.notifications.bulk_write(operations, ordered=False)
+            report["sequenced"] += len(operations)
+    
+    # The unbroken run of read notifications from the oldest onward becomes the
+    # watermark; only read notifications after the first unread one are listed
+    if await db.notifications.find_one({"read": True}, {"_id": 1}):
+        read_through, read_entries, unread_seen = 0, [], False
+        async for n in db.notifications.find({}, {"_id": 0, "id": 1, "seq": 1, "read": 1}).sort("seq", 1):
+            if not n.get("read"):
+                unread_seen = True
+                continue
+            report["readFlags"] += 1
+            if unread_seen:
+                read_entries.append({"id": n["id"], "seq": n["seq"]})
+            else:
+                read_through = n["seq"]
+        await db.notification_reads.update_one(
+            {"_id": DEFAULT_READ_STATE_ID},
+            {"$max": {"readThrough": read_through}, "$addToSet": {"readIds": {"$each": read_entries}}},
+            upsert=True
+        )
+    await db.notifications.update_many({"read": {"$exists": True}}, {"$unset": {"read": ""}})
+    
+    operations = []
+    async for n in db.notifications.find({"expiresAt": {"$exists": False}}, {"_id": 0, "id": 1, "createdAt": 1}):
+        try:
+            created = datetime.fromisoformat(n["createdAt"])
+        except (TypeError, ValueError):
+            created = datetime.now(timezone.utc)
+        operations.append(UpdateOne(
+            {"id": n["id"]},
+            {"$set": {"expiresAt": created + timedelta(days=NOTIFICATION_RETENTION_DAYS)}}
+        ))
+    if operations:
+        await db.notifications.bulk_write(operations, ordered=False)
+    report["expiries"] = len(operations)
+    
+    if any(report.values()):
+        logging.info(
+            f"Numbered {report['sequenced']} notifications, migrated {report['readFlags']} read flags "
+            f"and set expiry on {report['expiries']} notifications"
+        )
+    return report
+
 @api_router.delete("/notifications/{notification_id}")
 async def delete_notification(notification_id: str):
     try:
@@ -554,63 +2962,364 @@ async def delete_notification(notification_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ==================== Event Stream API ====================
+
+@api_router.get("/stream")
+async def stream_events(request: Request, last_event_id: Optional[str] = Query(None, alias="lastEventId")):
+    """
+    Server-Sent Events feed of "notification" and "purchase" events. Reconnecting
+    clients resume via the Last-Event-ID header (or ?lastEventId=); a "reset" event
+    means events were missed and the client should refetch.
+    """
+    resume_from = request.headers.get("last-event-id") or last_event_id
+    # Subscribe before reading the backlog so nothing falls between the two
+    queue = event_broker.subscribe()
+    
+    async def events():
+        try:
+            yield f"retry: {STREAM_RETRY_SECONDS * 1000}\n\n"
+            backlog = await stream_backlog(resume_from)
+            replayed = {event["id"] for event in backlog}
+            for event in backlog:
+                yield format_sse(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                if event["id"] in replayed:
+                    continue
+                yield format_sse(event)
+        finally:
+            event_broker.unsubscribe(queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 # ==================== Attachments API ====================
 
-@api_router.post("/purchases/{purchase_id}/attachments")
-async def upload_attachment(
-    purchase_id: str,
-    file: UploadFile = File(...),
-    uploaded_by: str = Form("System")
-):
+def _too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"File too large. Maximum size is {limit // (1024 * 1024)}MB")
+
+# Room for the multipart boundaries, part headers and small form fields around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+def _append_chunk(path: Path, chunk: bytes, hasher=None):
+    with open(path, "ab") as f:
+        f.write(chunk)
+    if hasher is not None:
+        hasher.update(chunk)
+
+def _hash_file(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _discard(path: Path):
     try:
-        # Check if purchase exists
-        existing = await db.purchases.find_one({"id": purchase_id})
-        if not existing:
-            raise HTTPException(status_code=404, detail="Purchase not found")
-        
-        # Validate file size (max 10MB)
-        contents = await file.read()
-        if len(contents) > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB")
-        
-        # Generate unique filename
-        file_id = str(uuid.uuid4())
-        file_ext = Path(file.filename).suffix
-        stored_filename = f"{file_id}{file_ext}"
-        file_path = UPLOADS_DIR / stored_filename
-        
-        # Save file
-        with open(file_path, "wb") as f:
-            f.write(contents)
-        
-        # Create attachment record
-        attachment = {
-            "id": file_id,
-            "filename": stored_filename,
-            "originalName": file.filename,
-            "mimeType": file.content_type or "application/octet-stream",
-            "size": len(contents),
-            "uploadedAt": datetime.now(timezone.utc).isoformat(),
-            "uploadedBy": uploaded_by
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+class _UploadPart:
+    def __init__(self):
+        self.headers: Dict[bytes, bytes] = {}
+        self.name = ""
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None
+        self.value = bytearray()
+
+async def receive_attachment_upload(request: Request, limit: int) -> dict:
+    """
+    Read a multipart upload from the request stream in one pass. The "file" part
+    is hashed and appended to INCOMING_DIR as it arrives, failing as soon as it
+    passes limit; the other parts are returned as form fields.
+    Returns {"fields", "path", "filename", "contentType", "size", "sha256"}.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body with a boundary")
+    cap = limit + MULTIPART_OVERHEAD
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > cap:
+        raise _too_large(limit)
+    
+    parts: List[_UploadPart] = []
+    header = [b"", b""]
+    # Parser callbacks are synchronous, so the data they see is handled after each write
+    pending: List[tuple] = []
+    finished = False
+    
+    def on_part_begin():
+        parts.append(_UploadPart())
+    
+    def on_header_field(data, start, end):
+        header[0] += data[start:end]
+    
+    def on_header_value(data, start, end):
+        header[1] += data[start:end]
+    
+    def on_header_end():
+        parts[-1].headers[header[0].lower()] = header[1]
+        header[0], header[1] = b"", b""
+    
+    def on_headers_finished():
+        part = parts[-1]
+        _, disposition = parse_options_header(part.headers.get(b"content-disposition", b""))
+        part.name = disposition.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" in disposition:
+            part.filename = disposition[b"filename"].decode("utf-8", "replace")
+            part.content_type = part.headers.get(b"content-type", b"").decode("latin-1") or None
+    
+    def on_part_data(data, start, end):
+        pending.append((parts[-1], data[start:end]))
+    
+    def on_end():
+        nonlocal finished
+        finished = True
+    
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_end": on_end,
+    })
+    
+    path = INCOMING_DIR / f"{uuid.uuid4()}.part"
+    hasher = hashlib.sha256()
+    file_part = None
+    size = received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > cap:
+                raise _too_large(limit)
+            try:
+                parser.write(chunk)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid multipart body: {e}")
+            
+            file_data = []
+            for part, data in pending:
+                if part.filename is None:
+                    part.value += data
+                elif part.name == "file" and file_part in (None, part):
+                    file_part = part
+                    file_data.append(data)
+                else:
+                    raise HTTPException(status_code=400, detail="Only one file may be uploaded, as the 'file' field")
+            pending.clear()
+            if file_data:
+                data = b"".join(file_data)
+                size += len(data)
+                if size > limit:
+                    raise _too_large(limit)
+                # Disk writes and hashing stay off the event loop
+                await run_in_threadpool(_append_chunk, path, data, hasher)
+        if not finished:
+            raise HTTPException(status_code=400, detail="Invalid multipart body: it ended early")
+        if file_part is None:
+            file_part = next((p for p in parts if p.name == "file" and p.filename is not None), None)
+            if file_part is None:
+                raise HTTPException(status_code=400, detail="No file uploaded")
+            # An empty file sends no data
+            await run_in_threadpool(_append_chunk, path, b"", hasher)
+    except BaseException:
+        await run_in_threadpool(_discard, path)
+        raise
+    
+    return {
+        "fields": {p.name: p.value.decode("utf-8", "replace") for p in parts if p.filename is None},
+        "path": path,
+        "filename": file_part.filename,
+        "contentType": file_part.content_type,
+        "size": size,
+        "sha256": hasher.hexdigest(),
+    }
+
+def blob_relative_path(sha256: str) -> str:
+    """Location of a blob relative to UPLOADS_DIR, sharded by the leading hash bytes"""
+    return f"blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+def is_blob_attachment(attachment: dict) -> bool:
+    return bool(attachment.get("sha256")) and attachment.get("filename", "").startswith("blobs/")
+
+def _place_blob(incoming: Path, target: Path):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Identical content may already be there; replacing it keeps the write atomic
+    # and also restores a file a concurrent garbage collection just removed
+    os.replace(incoming, target)
+
+async def acquire_blob(incoming: Path, sha256: str, size: int) -> str:
+    """Take a reference on the blob for sha256, storing incoming if it is new; returns its relative path"""
+    relative = blob_relative_path(sha256)
+    # Reference first, file second: a collector that sees refCount > 0 keeps the file
+    await db.attachment_blobs.update_one(
+        {"_id": sha256},
+        {
+            "$inc": {"refCount": 1},
+            "$setOnInsert": {"size": size, "path": relative, "createdAt": datetime.now(timezone.utc).isoformat()}
+        },
+        upsert=True
+    )
+    await run_in_threadpool(_place_blob, incoming, UPLOADS_DIR / relative)
+    return relative
+
+async def release_blob(sha256: str):
+    """Drop one reference and collect the blob once nothing points at it"""
+    blob = await db.attachment_blobs.find_one_and_update(
+        {"_id": sha256},
+        {"$inc": {"refCount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob and blob["refCount"] <= 0:
+        await collect_blob(sha256)
+
+async def collect_blob(sha256: str) -> bool:
+    """Delete an unreferenced blob; returns whether its file was removed"""
+    if not await db.attachment_blobs.find_one_and_delete({"_id": sha256, "refCount": {"$lte": 0}}):
+        return False
+    path = UPLOADS_DIR / blob_relative_path(sha256)
+    trash = INCOMING_DIR / f"{sha256}.{uuid.uuid4()}.trash"
+    try:
+        await run_in_threadpool(os.replace, path, trash)
+    except FileNotFoundError:
+        return False
+    # An upload of the same content may have re-referenced it in the meantime
+    if await db.attachment_blobs.find_one({"_id": sha256, "refCount": {"$gt": 0}}, {"_id": 1}):
+        await run_in_threadpool(_place_blob, trash, path)
+        return False
+    await run_in_threadpool(_discard, trash)
+    return True
+
+async def release_attachment_file(attachment: dict):
+    """Free the storage behind an attachment record, blob or legacy flat file"""
+    if is_blob_attachment(attachment):
+        await release_blob(attachment["sha256"])
+    else:
+        await run_in_threadpool(_discard, UPLOADS_DIR / attachment["filename"])
+
+def _stale_files(directory: Path, pattern: str, keep: set, older_than: float) -> List[Path]:
+    if not directory.exists():
+        return []
+    return [
+        path for path in directory.glob(pattern)
+        if path.is_file() and path.name not in keep and path.stat().st_mtime < older_than
+    ]
+
+async def compact_attachment_storage() -> dict:
+    """Remove unreferenced blobs, orphaned legacy files and abandoned partial uploads"""
+    report = {"blobs": 0, "orphanedBlobFiles": 0, "legacyFiles": 0, "partialUploads": 0}
+    older_than = datetime.now(timezone.utc).timestamp() - ORPHAN_GRACE_SECONDS
+    
+    async for blob in db.attachment_blobs.find({"refCount": {"$lte": 0}}, {"_id": 1}):
+        if await collect_blob(blob["_id"]):
+            report["blobs"] += 1
+    
+    # Blob files whose reference document is gone, e.g. after a crash
+    known_blobs = set(await db.attachment_blobs.distinct("_id"))
+    for path in await run_in_threadpool(_stale_files, BLOBS_DIR, "*/*/*", known_blobs, older_than):
+        await run_in_threadpool(_discard, path)
+        report["orphanedBlobFiles"] += 1
+    
+    # Flat files from before the blob store, including those delete_purchase used to leave behind
+    referenced = set(await db.purchases.distinct("attachments.filename"))
+    for path in await run_in_threadpool(_stale_files, UPLOADS_DIR, "*", referenced, older_than):
+        await run_in_threadpool(_discard, path)
+        report["legacyFiles"] += 1
+    
+    open_sessions = {f"{s}.part" for s in await db.attachment_uploads.distinct("id")}
+    for path in await run_in_threadpool(_stale_files, INCOMING_DIR, "*", open_sessions, older_than):
+        await run_in_threadpool(_discard, path)
+        report["partialUploads"] += 1
+    
+    if any(report.values()):
+        logging.info(f"Attachment compaction: {report}")
+    return report
+
+async def store_attachment(
+    purchase_id: str,
+    incoming: Path,
+    original_name: str,
+    mime_type: str,
+    size: int,
+    sha256: str,
+    uploaded_by: str
+) -> dict:
+    """Store a fully received file in the blob store and record it on the purchase"""
+    attachment = {
+        "id": str(uuid.uuid4()),
+        "filename": await acquire_blob(incoming, sha256, size),
+        "originalName": original_name,
+        "mimeType": mime_type,
+        "size": size,
+        "uploadedAt": datetime.now(timezone.utc).isoformat(),
+        "uploadedBy": uploaded_by,
+        "sha256": sha256
+    }
+    
+    result = await db.purchases.update_one(
+        {"id": purchase_id},
+        {
+            "$push": {"attachments": attachment},
+            "$set": {"updatedAt": utc_now()}
         }
+    )
+    if result.matched_count == 0:
+        # Purchase deleted while the file was uploading
+        await release_blob(sha256)
+        raise HTTPException(status_code=404, detail="Purchase not found")
+    
+    await append_audit(purchase_id, create_audit_entry(
+        "attachment_added",
+        uploaded_by,
+        f"Attachment '{original_name}' added"
+    ))
+    await purchases_changed()
+    return attachment
+
+async def ensure_purchase_exists(purchase_id: str):
+    if not await db.purchases.find_one({"id": purchase_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Purchase not found")
+
+# The body is parsed by the handler rather than through File()/Form() parameters,
+# which would have FastAPI spool the whole upload before any size check runs
+@api_router.post(
+    "/purchases/{purchase_id}/attachments",
+    openapi_extra={"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "required": ["file"],
+        "properties": {
+            "file": {"type": "string", "format": "binary"},
+            "uploaded_by": {"type": "string", "default": "System"},
+        },
+    }}}}}
+)
+async def upload_attachment(purchase_id: str, request: Request):
+    try:
+        await ensure_purchase_exists(purchase_id)
         
-        # Add audit entry
-        audit_entry = create_audit_entry(
-            "attachment_added",
-            uploaded_by,
-            f"Attachment '{file.filename}' added"
-        )
+        upload = await receive_attachment_upload(request, MAX_ATTACHMENT_SIZE)
         
-        # Update purchase
-        await db.purchases.update_one(
-            {"id": purchase_id},
-            {
-                "$push": {
-                    "attachments": attachment,
-                    "auditTrail": audit_entry
-                },
-                "$set": {"updatedAt": datetime.now(timezone.utc).isoformat()}
-            }
+        attachment = await store_attachment(
+            purchase_id,
+            upload["path"],
+            upload["filename"],
+            upload["contentType"] or "application/octet-stream",
+            upload["size"],
+            upload["sha256"],
+            upload["fields"].get("uploaded_by") or "System"
         )
         
         return {"message": "File uploaded successfully", "attachment": attachment}
@@ -621,30 +3330,258 @@ async def upload_attachment(
         logging.error(f"Error uploading attachment: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/purchases/{purchase_id}/attachments/{attachment_id}")
-async def download_attachment(purchase_id: str, attachment_id: str):
+# Resumable uploads: create a session, PUT raw byte ranges at the reported
+# offset (retrying from GET's "received" after a dropped connection), then complete
+@api_router.post("/purchases/{purchase_id}/attachments/uploads", response_model=UploadSession)
+async def create_upload_session(
+    purchase_id: str,
+    filename: str = Form(...),
+    size: int = Form(..., ge=0),
+    mime_type: str = Form("application/octet-stream"),
+    uploaded_by: str = Form("System")
+):
     try:
-        # Find purchase
-        purchase = await db.purchases.find_one({"id": purchase_id})
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Purchase not found")
+        await ensure_purchase_exists(purchase_id)
+        if size > MAX_RESUMABLE_ATTACHMENT_SIZE:
+            raise _too_large(MAX_RESUMABLE_ATTACHMENT_SIZE)
         
-        # Find attachment
-        attachment = next(
-            (a for a in purchase.get("attachments", []) if a["id"] == attachment_id),
-            None
+        session = UploadSession(
+            id=str(uuid.uuid4()),
+            purchaseId=purchase_id,
+            originalName=filename,
+            mimeType=mime_type,
+            size=size,
+            uploadedBy=uploaded_by,
+            createdAt=datetime.now(timezone.utc).isoformat()
         )
-        if not attachment:
-            raise HTTPException(status_code=404, detail="Attachment not found")
+        await run_in_threadpool(_append_chunk, INCOMING_DIR / f"{session.id}.part", b"")
+        await db.attachment_uploads.insert_one({
+            **session.model_dump(),
+            "expiresAt": datetime.now(timezone.utc) + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+        })
+        return session
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error creating upload session: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def get_upload_session_or_404(purchase_id: str, upload_id: str) -> dict:
+    session = await db.attachment_uploads.find_one({"id": upload_id, "purchaseId": purchase_id}, {"_id": 0})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+@api_router.get("/purchases/{purchase_id}/attachments/uploads/{upload_id}", response_model=UploadSession)
+async def get_upload_session(purchase_id: str, upload_id: str):
+    try:
+        return UploadSession(**await get_upload_session_or_404(purchase_id, upload_id))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching upload session: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.put("/purchases/{purchase_id}/attachments/uploads/{upload_id}", response_model=UploadSession)
+async def upload_chunk(
+    purchase_id: str,
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0, description="Byte offset of this chunk; must equal the session's received count")
+):
+    try:
+        session = await get_upload_session_or_404(purchase_id, upload_id)
+        if offset != session["received"]:
+            raise HTTPException(status_code=409, detail=f"Expected offset {session['received']}")
+        
+        # Drop bytes from an earlier attempt that died before being acknowledged
+        path = INCOMING_DIR / f"{upload_id}.part"
+        await run_in_threadpool(os.truncate, path, offset)
+        received = offset
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            if received + len(chunk) > session["size"]:
+                raise HTTPException(status_code=400, detail="Chunk exceeds the declared file size")
+            await run_in_threadpool(_append_chunk, path, chunk)
+            received += len(chunk)
+        
+        # Conditional on the old offset so concurrent PUTs can't both append
+        updated = await db.attachment_uploads.find_one_and_update(
+            {"id": upload_id, "received": offset},
+            {"$set": {"received": received}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not updated:
+            raise HTTPException(status_code=409, detail="Upload session changed concurrently")
+        updated.pop("_id", None)
+        return UploadSession(**updated)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error uploading chunk: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/purchases/{purchase_id}/attachments/uploads/{upload_id}/complete")
+async def complete_upload_session(
+    purchase_id: str,
+    upload_id: str,
+    sha256: Optional[str] = Form(None, description="Expected SHA-256 of the whole file")
+):
+    try:
+        session = await get_upload_session_or_404(purchase_id, upload_id)
+        if session["received"] != session["size"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload incomplete: received {session['received']} of {session['size']} bytes"
+            )
+        
+        path = INCOMING_DIR / f"{upload_id}.part"
+        digest = await run_in_threadpool(_hash_file, path)
+        if sha256 and sha256.lower() != digest:
+            raise HTTPException(status_code=400, detail="SHA-256 mismatch")
+        
+        # Claim the session so a retried complete can't attach the file twice
+        if not await db.attachment_uploads.find_one_and_delete({"id": upload_id}):
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        
+        attachment = await store_attachment(
+            purchase_id,
+            path,
+            session["originalName"],
+            session["mimeType"],
+            session["size"],
+            digest,
+            session["uploadedBy"]
+        )
+        return {"message": "File uploaded successfully", "attachment": attachment}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error completing upload: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def find_attachment(purchase_id: str, attachment_id: str) -> dict:
+    """Fetch a single attachment record without loading the rest of the purchase"""
+    purchase = await db.purchases.find_one(
+        {"id": purchase_id, "attachments.id": attachment_id},
+        {"_id": 0, "attachments.$": 1}
+    )
+    if not purchase:
+        await ensure_purchase_exists(purchase_id)
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return purchase["attachments"][0]
+
+def attachment_etag(attachment: dict, stat: os.stat_result) -> str:
+    # Blob content never changes for a given hash, so it makes a strong validator
+    if attachment.get("sha256"):
+        return f'"{attachment["sha256"]}"'
+    return f'W/"{stat.st_size:x}-{int(stat.st_mtime):x}"'
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Weak comparison as used for If-None-Match"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag.removeprefix("W/") in tags
+
+def parse_byte_range(header: Optional[str], size: int) -> Optional[tuple]:
+    """Parse a single-range Range header into (start, end); None means serve the whole file"""
+    if not header or not header.startswith("bytes="):
+        return None
+    ranges = header[len("bytes="):].split(",")
+    if len(ranges) != 1:
+        # Multipart ranges aren't worth the complexity for PDFs and scans
+        return None
+    # Anything else, including a last position before the first, isn't a valid
+    # range and is ignored rather than refused (RFC 9110 section 14.2)
+    spec = re.fullmatch(r"(\d*)-(\d*)", ranges[0].strip(), re.ASCII)
+    if not spec or not any(spec.groups()):
+        return None
+    start_text, end_text = spec.groups()
+    if not start_text:
+        # Suffix range: the last N bytes
+        length = int(end_text)
+        start, end = max(size - length, 0), size - 1
+        satisfiable = length > 0 and size > 0
+    else:
+        start = int(start_text)
+        if end_text and int(end_text) < start:
+            return None
+        end = min(int(end_text), size - 1) if end_text else size - 1
+        satisfiable = start < size
+    if not satisfiable:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+async def iter_file_range(path: Path, start: int, end: int):
+    async with await anyio.open_file(path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+@api_router.get("/purchases/{purchase_id}/attachments/{attachment_id}")
+async def download_attachment(purchase_id: str, attachment_id: str, request: Request):
+    try:
+        attachment = await find_attachment(purchase_id, attachment_id)
         
         file_path = UPLOADS_DIR / attachment["filename"]
-        if not file_path.exists():
+        try:
+            stat = await anyio.Path(file_path).stat()
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail="File not found on server")
         
-        return FileResponse(
-            path=file_path,
-            filename=attachment["originalName"],
-            media_type=attachment["mimeType"]
+        etag = attachment_etag(attachment, stat)
+        filename = attachment["originalName"]
+        quoted = quote(filename)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Accept-Ranges": "bytes",
+            # An attachment id always refers to the same bytes
+            "Cache-Control": "private, max-age=31536000, immutable",
+            "Content-Disposition": (
+                f'attachment; filename="{filename}"' if quoted == filename
+                else f"attachment; filename*=utf-8''{quoted}"
+            )
+        }
+        
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        
+        byte_range = parse_byte_range(request.headers.get("range"), stat.st_size)
+        # If-Range needs a strong match, otherwise the client gets the whole (changed) file
+        if_range = request.headers.get("if-range")
+        if byte_range and if_range and (etag.startswith("W/") or if_range.strip() != etag):
+            byte_range = None
+        
+        if byte_range is None:
+            headers["Content-Length"] = str(stat.st_size)
+            return StreamingResponse(
+                iter_file_range(file_path, 0, stat.st_size - 1),
+                media_type=attachment["mimeType"],
+                headers=headers
+            )
+        
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            iter_file_range(file_path, start, end),
+            status_code=206,
+            media_type=attachment["mimeType"],
+            headers=headers
         )
     
     except HTTPException:
@@ -656,23 +3593,19 @@ async def download_attachment(purchase_id: str, attachment_id: str):
 @api_router.delete("/purchases/{purchase_id}/attachments/{attachment_id}")
 async def delete_attachment(purchase_id: str, attachment_id: str, deleted_by: str = "System"):
     try:
-        # Find purchase
-        purchase = await db.purchases.find_one({"id": purchase_id})
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Purchase not found")
+        attachment = await find_attachment(purchase_id, attachment_id)
         
-        # Find attachment
-        attachment = next(
-            (a for a in purchase.get("attachments", []) if a["id"] == attachment_id),
-            None
+        # Update purchase; only the request that actually removed the record frees the file
+        result = await db.purchases.update_one(
+            {"id": purchase_id, "attachments.id": attachment_id},
+            {
+                "$pull": {"attachments": {"id": attachment_id}},
+                "$set": {"updatedAt": utc_now()}
+            }
         )
-        if not attachment:
+        if result.modified_count == 0:
             raise HTTPException(status_code=404, detail="Attachment not found")
-        
-        # Delete file from disk
-        file_path = UPLOADS_DIR / attachment["filename"]
-        if file_path.exists():
-            file_path.unlink()
+        await release_attachment_file(attachment)
         
         # Add audit entry
         audit_entry = create_audit_entry(
@@ -680,16 +3613,8 @@ async def delete_attachment(purchase_id: str, attachment_id: str, deleted_by: st
             deleted_by,
             f"Attachment '{attachment['originalName']}' removed"
         )
-        
-        # Update purchase
-        await db.purchases.update_one(
-            {"id": purchase_id},
-            {
-                "$pull": {"attachments": {"id": attachment_id}},
-                "$push": {"auditTrail": audit_entry},
-                "$set": {"updatedAt": datetime.now(timezone.utc).isoformat()}
-            }
-        )
+        await append_audit(purchase_id, audit_entry)
+        await purchases_changed()
         
         return {"message": "Attachment deleted successfully"}
     
@@ -702,25 +3627,423 @@ async def delete_attachment(purchase_id: str, attachment_id: str, deleted_by: st
 
 # ==================== Audit Trail API ====================
 
-@api_router.get("/purchases/{purchase_id}/history")
-async def get_purchase_history(purchase_id: str):
+@api_router.get("/purchases/{purchase_id}/history", response_model=PurchaseHistory)
+async def get_purchase_history(
+    purchase_id: str,
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+    cursor: Optional[str] = Query(None, description="Cursor returned as nextCursor by the previous page")
+):
     try:
-        purchase = await db.purchases.find_one({"id": purchase_id}, {"_id": 0})
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Purchase not found")
+        async def render(version: str) -> tuple:
+            purchase = await db.purchases.find_one(
+                {"id": purchase_id},
+                {"_id": 0, "prNo": 1, "title": 1, "createdAt": 1, "updatedAt": 1}
+            )
+            if not purchase:
+                raise HTTPException(status_code=404, detail="Purchase not found")
+            
+            # Oldest first, like the embedded trail used to be
+            query = {"purchaseId": purchase_id}
+            page_query = query
+            if cursor:
+                after = decode_cursor(cursor, ("timestamp", "id"))
+                page_query = {
+                    "purchaseId": purchase_id,
+                    "$or": [
+                        {"timestamp": {"$gt": after["timestamp"]}},
+                        {"timestamp": after["timestamp"], "id": {"$gt": after["id"]}}
+                    ]
+                }
+            
+            entries, total = await asyncio.gather(
+                db.purchase_audit.find(page_query, {"_id": 0, "purchaseId": 0})
+                    .sort([("timestamp", ASCENDING), ("id", ASCENDING)])
+                    .limit(limit + 1)
+                    .to_list(limit + 1),
+                db.purchase_audit.count_documents(query)
+            )
+            has_more = len(entries) > limit
+            entries = entries[:limit]
+            
+            # Audit entries are only added alongside writes that set updatedAt
+            etag = document_etag(purchase_id, purchase.get("updatedAt") or purchase.get("createdAt"), limit, cursor)
+            return etag, ORJSONResponse({
+                "purchaseId": purchase_id,
+                "prNo": purchase.get("prNo"),
+                "title": purchase.get("title"),
+                "history": [
+                    {**AUDIT_DEFAULTS, **entry, "timestamp": format_datetime(entry.get("timestamp"))}
+                    for entry in entries
+                ],
+                "total": total,
+                "hasMore": has_more,
+                "nextCursor": encode_cursor(entries[-1], ("timestamp", "id")) if has_more else None
+            }).body
         
-        return {
-            "purchaseId": purchase_id,
-            "prNo": purchase.get("prNo"),
-            "title": purchase.get("title"),
-            "history": purchase.get("auditTrail", [])
-        }
+        return await cached_purchase_read(request, ("history", purchase_id, limit, cursor), render)
     except HTTPException:
         raise
     except Exception as e:
         logging.error(f"Error fetching history: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def migrate_embedded_audit_trails() -> dict:
+    """Move auditTrail arrays left in purchase documents into purchase_audit"""
+    migrated_purchases = 0
+    migrated_entries = 0
+    cursor = db.purchases.find({"auditTrail": {"$exists": True}}, {"_id": 0, "id": 1, "auditTrail": 1})
+    async for purchase in cursor:
+        # Deterministic ids make a re-run after an interruption a no-op
+        operations = [
+            UpdateOne(
+                {"id": f"{purchase['id']}:{index}"},
+                {"$setOnInsert": audit_document(purchase["id"], {
+                    **entry,
+                    "id": f"{purchase['id']}:{index}",
+                    "timestamp": stored_timestamp(entry.get("timestamp"))
+                })},
+                upsert=True
+            )
+            for index, entry in enumerate(purchase.get("auditTrail") or [])
+        ]
+        if operations:
+            await db.purchase_audit.bulk_write(operations, ordered=False)
+        await db.purchases.update_one({"id": purchase["id"]}, {"$unset": {"auditTrail": ""}})
+        migrated_purchases += 1
+        migrated_entries += len(operations)
+    
+    if migrated_purchases:
+        await purchases_changed()
+        logging.info(f"Moved {migrated_entries} audit entries out of {migrated_purchases} purchases")
+    return {"purchases": migrated_purchases, "entries": migrated_entries}
+
+AMOUNT_MIGRATION_BATCH_SIZE = 500
+DATE_MIGRATION_BATCH_SIZE = 500
+
+def stored_timestamp(value):
+    """Parse a legacy timestamp for storage, keeping values that don't parse as they are"""
+    try:
+        return parse_datetime(value)
+    except (TypeError, ValueError):
+        return value
+
+async def migrate_string_dates() -> dict:
+    """
+    Convert purchase dates and audit timestamps stored as ISO strings to BSON
+    datetimes. A date that doesn't parse is set to null and kept in unparsedDate.
+    """
+    report = {"purchases": 0, "auditEntries": 0, "unparsedDates": 0}
+    
+    operations = []
+    string_dates = {"$or": [{field: {"$type": "string"}} for field in ("date", *PURCHASE_TIMESTAMP_FIELDS)]}
+    projection = {"_id": 0, "id": 1, "date": 1, **{field: 1 for field in PURCHASE_TIMESTAMP_FIELDS}}
+    async for purchase in db.purchases.find(string_dates, projection):
+        update = {}
+        if isinstance(purchase.get("date"), str):
+            try:
+                update["date"] = parse_date(purchase["date"])
+            except ValueError:
+                update["date"] = None
+                update["unparsedDate"] = purchase["date"]
+                report["unparsedDates"] += 1
+        for field in PURCHASE_TIMESTAMP_FIELDS:
+            if isinstance(purchase.get(field), str):
+                update[field] = stored_timestamp(purchase[field])
+        # Only fields still holding the string we read are replaced, so concurrent writes win
+        match = {"id": purchase["id"], **{field: purchase[field] for field in update if field in purchase}}
+        operations.append(UpdateOne(match, {"$set": update}))
+        if len(operations) >= DATE_MIGRATION_BATCH_SIZE:
+            await db.purchases.bulk_write(operations, ordered=False)
+            report["purchases"] += len(operations)
+            operations = []
+    if operations:
+        await db.purchases.bulk_write(operations, ordered=False)
+        report["purchases"] += len(operations)
+    
+    operations = []
+    async for entry in db.purchase_audit.find({"timestamp": {"$type": "string"}}, {"_id": 0, "id": 1, "timestamp": 1}):
+        timestamp = stored_timestamp(entry["timestamp"])
+        if isinstance(timestamp, datetime):
+            operations.append(UpdateOne({"id": entry["id"]}, {"$set": {"timestamp": timestamp}}))
+        if len(operations) >= DATE_MIGRATION_BATCH_SIZE:
+            await db.purchase_audit.bulk_write(operations, ordered=False)
+            report["auditEntries"] += len(operations)
+            operations = []
+    if operations:
+        await db.purchase_audit.bulk_write(operations, ordered=False)
+        report["auditEntries"] += len(operations)
+    
+    if report["purchases"] or report["auditEntries"]:
+        await purchases_changed()
+        logging.info(
+            f"Converted dates of {report['purchases']} purchases and {report['auditEntries']} audit entries "
+            f"({report['unparsedDates']} unparsable dates kept in unparsedDate)"
+        )
+    return report
+
+def _same_amount(stored, centavos: int) -> bool:
+    try:
+        return to_centavos(stored) == centavos
+    except (ArithmeticError, TypeError, ValueError):
+        return False
+
+async def migrate_purchase_amounts() -> dict:
+    """
+    Price purchases stored before amounts were kept in centavos from their items.
+    A stored total the items don't add up to is kept in legacyTotalAmount and the
+    change is recorded in the purchase's history.
+    """
+    report = {"purchases": 0, "totalsChanged": 0}
+    operations = []
+    audit_entries = []
+    
+    async def flush():
+        nonlocal operations, audit_entries
+        if operations:
+            await db.purchases.bulk_write(operations, ordered=False)
+            report["purchases"] += len(operations)
+            operations = []
+        if audit_entries:
+            await db.purchase_audit.insert_many(audit_entries, ordered=False)
+            report["totalsChanged"] += len(audit_entries)
+            audit_entries = []
+    
+    async for purchase in db.purchases.find(
+        {"totalCentavos": {"$exists": False}}, {"_id": 0, "id": 1, "items": 1, "totalAmount": 1}
+    ):
+        stored_total = purchase.get("totalAmount")
+        priced = price_purchase(purchase)
+        update = {
+            "items": priced["items"],
+            "totalAmount": priced["totalAmount"],
+            "totalCentavos": priced["totalCentavos"]
+        }
+        if stored_total is not None and not _same_amount(stored_total, priced["totalCentavos"]):
+            update["legacyTotalAmount"] = stored_total
+            audit_entries.append(audit_document(purchase["id"], create_audit_entry(
+                "updated",
+                "System",
+                f"Total recomputed from items: {stored_total} to {priced['totalAmount']}",
+                str(stored_total),
+                str(priced["totalAmount"])
+            )))
+        # The filter leaves alone purchases a write has priced in the meantime
+        operations.append(UpdateOne({"id": purchase["id"], "totalCentavos": {"$exists": False}}, {"$set": update}))
+        if len(operations) >= AMOUNT_MIGRATION_BATCH_SIZE:
+            await flush()
+    await flush()
+    
+    if report["purchases"]:
+        await rebuild_dashboard_stats()
+        await purchases_changed()
+        logging.info(
+            f"Recomputed amounts of {report['purchases']} purchases in centavos; "
+            f"{report['totalsChanged']} stored totals differed and were kept in legacyTotalAmount"
+        )
+    return report
+
+
+# ==================== Admin API ====================
+
+@api_router.get("/admin/indexes")
+async def get_index_stats():
+    try:
+        report = {}
+        for collection_name in INDEX_SPECS:
+            collection = db[collection_name]
+            indexes = await collection.index_information()
+            
+            # $indexStats needs the clusterMonitor role on some deployments
+            usage = {}
+            try:
+                async for stat in collection.aggregate([{"$indexStats": {}}]):
+                    usage[stat["name"]] = {
+                        "ops": stat["accesses"]["ops"],
+                        "since": stat["accesses"]["since"].isoformat()
+                    }
+            except Exception as e:
+                logging.warning(f"$indexStats unavailable for {collection_name}: {e}")
+            
+            report[collection_name] = [
+                {
+                    "name": name,
+                    "key": [[field, direction] for field, direction in info.get("key", [])],
+                    "unique": bool(info.get("unique", False)),
+                    "managed": name.startswith(INDEX_PREFIX),
+                    "usage": usage.get(name)
+                }
+                for name, info in indexes.items()
+            ]
+            
+            # Declared but missing means creation failed at startup
+            report[collection_name].extend(
+                {"name": m.document["name"], "missing": True}
+                for m in INDEX_SPECS[collection_name]
+                if m.document["name"] not in indexes
+            )
+        return report
+    except Exception as e:
+        logging.error(f"Error fetching index stats: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/admin/stats/check")
+async def check_dashboard_stats():
+    try:
+        materialized, actual = await asyncio.gather(
+            read_materialized_stats(),
+            compute_dashboard_stats({})
+        )
+        actual.pop("recentActivity", None)
+        differences = diff_stats(materialized, actual)
+        return {
+            "consistent": not differences,
+            "differences": differences,
+            "materialized": materialized,
+            "actual": actual
+        }
+    except Exception as e:
+        logging.error(f"Error checking stats: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/stats/rebuild")
+async def rebuild_stats():
+    try:
+        stats = await rebuild_dashboard_stats()
+        return {"message": "Dashboard stats rebuilt", "stats": stats}
+    except Exception as e:
+        logging.error(f"Error rebuilding stats: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/migrations/audit-trail")
+async def run_audit_trail_migration():
+    try:
+        result = await migrate_embedded_audit_trails()
+        return {"message": "Audit trail migration complete", **result}
+    except Exception as e:
+        logging.error(f"Error migrating audit trails: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/migrations/notifications")
+async def run_notification_migration():
+    try:
+        report = await migrate_legacy_notifications()
+        return {"message": "Notification migration complete", **report}
+    except Exception as e:
+        logging.error(f"Error migrating notifications: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/migrations/amounts")
+async def run_amount_migration():
+    try:
+        report = await migrate_purchase_amounts()
+        return {"message": "Amount migration complete", **report}
+    except Exception as e:
+        logging.error(f"Error migrating amounts: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/migrations/dates")
+async def run_date_migration():
+    try:
+        report = await migrate_string_dates()
+        return {"message": "Date migration complete", **report}
+    except Exception as e:
+        logging.error(f"Error migrating dates: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/admin/slow-queries")
+async def get_slow_queries(
+    hours: int = Query(24, ge=1, description="Only include queries recorded in this many hours"),
+    limit: int = Query(50, ge=1, le=500)
+):
+    """Slow query shapes ordered by total time spent, with the latest explained plan of each"""
+    try:
+        since = datetime.now(timezone.utc) - timedelta(hours=hours)
+        shapes = await db.slow_queries.aggregate([
+            {"$match": {"at": {"$gte": since}}},
+            {"$group": {
+                "_id": "$shapeId",
+                "shape": {"$first": "$shape"},
+                "collection": {"$first": "$collection"},
+                "command": {"$first": "$command"},
+                "count": {"$sum": 1},
+                "totalMs": {"$sum": "$durationMs"},
+                "avgMs": {"$avg": "$durationMs"},
+                "maxMs": {"$max": "$durationMs"},
+                "lastSeen": {"$max": "$at"},
+            }},
+            {"$sort": {"totalMs": -1}},
+            {"$limit": limit},
+        ]).to_list(limit)
+        
+        # Only some entries carry a plan, since each shape is explained at most once per interval
+        plans = await asyncio.gather(*(
+            db.slow_queries.find_one(
+                {"shapeId": shape["_id"], "plan": {"$exists": True}},
+                {"_id": 0, "plan": 1, "collscan": 1, "keysExamined": 1, "docsExamined": 1, "nReturned": 1},
+                sort=[("$natural", -1)]
+            )
+            for shape in shapes
+        ))
+        return {
+            "enabled": SLOW_QUERY_PROFILER,
+            "thresholdMs": SLOW_QUERY_THRESHOLD_MS,
+            "shapes": [
+                {
+                    "shapeId": shape.pop("_id"),
+                    **shape,
+                    "avgMs": round(shape["avgMs"], 2),
+                    "totalMs": round(shape["totalMs"], 2),
+                    **(plan or {"plan": None}),
+                }
+                for shape, plan in zip(shapes, plans)
+            ]
+        }
+    except Exception as e:
+        logging.error(f"Error fetching slow queries: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/attachments/compact")
+async def compact_attachments():
+    try:
+        report = await compact_attachment_storage()
+        return {"message": "Attachment storage compacted", **report}
+    except Exception as e:
+        logging.error(f"Error compacting attachments: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/admin/notifications/outbox")
+async def get_outbox_status():
+    try:
+        counts = await db.notification_outbox.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        failures = await db.notification_outbox.find(
+            {"status": {"$in": ["pending", "failed"]}, "attempts": {"$gt": 0}},
+            {"_id": 0, "id": 1, "status": 1, "attempts": 1, "lastError": 1, "nextAttemptAt": 1, "notification.title": 1}
+        ).sort("nextAttemptAt", ASCENDING).to_list(20)
+        return {
+            "sinks": [sink.name for sink in notification_sinks],
+            "counts": {c["_id"]: c["count"] for c in counts},
+            "retrying": failures,
+        }
+    except Exception as e:
+        logging.error(f"Error fetching outbox status: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/notifications/outbox/retry")
+async def retry_failed_notifications():
+    try:
+        result = await db.notification_outbox.update_many(
+            {"status": "failed"},
+            {"$set": {"status": "pending", "attempts": 0, "nextAttemptAt": datetime.now(timezone.utc)}}
+        )
+        outbox_wakeup.set()
+        return {"message": "Failed notifications requeued", "requeued": result.modified_count}
+    except Exception as e:
+        logging.error(f"Error requeuing notifications: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -732,6 +4055,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    
+    # Prometheus scrape endpoint; outside /api like the usual exporter path
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -739,6 +4070,103 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def startup_transactions():
+    global transactions_enabled
+    transactions_enabled = await detect_transaction_support()
+    logging.info(f"MongoDB transactions {'enabled' if transactions_enabled else 'disabled'}")
+
+@app.on_event("startup")
+async def startup_event_stream():
+    global change_streams_enabled
+    if CHANGE_STREAMS in ("false", "0", "no"):
+        return
+    change_streams_enabled = await is_replicated_deployment()
+    if change_streams_enabled:
+        app.state.change_stream = asyncio.create_task(follow_change_stream())
+    logging.info(f"Event stream using {'change streams' if change_streams_enabled else 'in-process publishing'}")
+
+@app.on_event("startup")
+async def startup_slow_query_profiler():
+    if not SLOW_QUERY_PROFILER:
+        return
+    try:
+        await ensure_slow_query_log()
+        slow_query_listener.loop = asyncio.get_running_loop()
+        logging.info(f"Slow query profiler recording reads over {SLOW_QUERY_THRESHOLD_MS} ms")
+    except Exception as e:
+        logging.error(f"Could not start slow query profiler: {e}")
+
+@app.on_event("startup")
+async def startup_date_migration():
+    # Awaited rather than run in the background: until it finishes, string and
+    # datetime values of the same field would sort and filter apart
+    try:
+        await migrate_string_dates()
+    except Exception as e:
+        logging.error(f"Date migration failed: {e}")
+
+@app.on_event("startup")
+async def startup_dashboard_stats():
+    # Counters only receive deltas, so they must be seeded before the first write
+    try:
+        if await db.purchase_stats.find_one({"_id": STATS_TOTALS_ID}) is None:
+            await rebuild_dashboard_stats()
+    except Exception as e:
+        logging.error(f"Could not seed dashboard stats: {e}")
+
+@app.on_event("startup")
+async def startup_audit_migration():
+    # Runs in the background so a large backlog doesn't delay startup
+    async def run():
+        try:
+            await migrate_embedded_audit_trails()
+        except Exception as e:
+            logging.error(f"Audit trail migration failed: {e}")
+    app.state.audit_migration = asyncio.create_task(run())
+
+@app.on_event("startup")
+async def startup_amount_migration():
+    # Background like the audit migration; it rebuilds the dashboard counters when done
+    async def run():
+        try:
+            await migrate_purchase_amounts()
+        except Exception as e:
+            logging.error(f"Amount migration failed: {e}")
+    app.state.amount_migration = asyncio.create_task(run())
+
+@app.on_event("startup")
+async def startup_notification_migration():
+    try:
+        await migrate_legacy_notifications()
+    except Exception as e:
+        logging.error(f"Notification migration failed: {e}")
+
+@app.on_event("startup")
+async def startup_attachment_compaction():
+    if ATTACHMENT_COMPACTION_INTERVAL <= 0:
+        return
+    async def run():
+        while True:
+            await asyncio.sleep(ATTACHMENT_COMPACTION_INTERVAL)
+            try:
+                await compact_attachment_storage()
+            except Exception as e:
+                logging.error(f"Attachment compaction failed: {e}")
+    app.state.attachment_compaction = asyncio.create_task(run())
+
+@app.on_event("startup")
+async def startup_outbox_worker():
+    app.state.outbox_worker = asyncio.create_task(run_outbox_worker())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Anything still queued stays in the outbox for the next start
+    outbox_worker = getattr(app.state, "outbox_worker", None)
+    if outbox_worker is not None:
+        outbox_worker.cancel()
     client.close()
\ No newline at end of file
@@ -151,23 +151,24 @@ class BackendTester:
             response = requests.get(f"{self.base_url}/purchases", timeout=10)
             
             if response.status_code == 200:
-                data = response.json()
+                page = response.json()
+                data = page.get("items") if isinstance(page, dict) else None
                 
                 if isinstance(data, list):
                     # Check if our created purchase is in the list
                     if self.test_purchase_id:
                         found = any(p.get("id") == self.test_purchase_id for p in data)
                         if found:
-                            self.log_result("Get All Purchases", True, f"Found {len(data)} purchases including our test purchase")
+                            self.log_result("Get All Purchases", True, f"Found {page['total']} purchases including our test purchase")
                             return True
                         else:
                             self.log_result("Get All Purchases", False, "Created purchase not found in list")
                             return False
                     else:
-                        self.log_result("Get All Purchases", True, f"Retrieved {len(data)} purchases")
+                        self.log_result("Get All Purchases", True, f"Retrieved {page['total']} purchases")
                         return True
                 else:
-                    self.log_result("Get All Purchases", False, f"Expected list, got: {type(data)}")
+                    self.log_result("Get All Purchases", False, f"Expected paginated envelope, got: {page}")
                     return False
             else:
                 self.log_result("Get All Purchases", False, f"Status: {response.status_code}, Response: {response.text}")
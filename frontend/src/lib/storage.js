@@ -68,11 +68,11 @@ export const exportToCSV = (purchases) => {
     return null;
   }
 
-  let csvContent = 'ID,PR_No,PO_No,OBR_No,DV_No,Title,Date,Department,Purpose,Status,Supplier1_Name,Supplier1_Address,Supplier2_Name,Supplier2_Address,Supplier3_Name,Supplier3_Address,Total_Amount,Items_JSON,Created_At\n';
+  let csvContent = 'ID,PR_No,PO_No,OBR_No,DV_No,Title,Date,Department,Purpose,Status,Supplier1_Name,Supplier1_Address,Supplier2_Name,Supplier2_Address,Supplier3_Name,Supplier3_Address,Total_Amount,Items_JSON,Created_At,Priority\n';
 
   purchases.forEach(p => {
     const itemsJson = JSON.stringify(p.items).replace(/"/g, '""');
-    csvContent += `"${p.id}","${p.prNo}","${p.poNo}","${p.obrNo}","${p.dvNo}","${p.title}","${p.date}","${p.department}","${p.purpose || ''}","${p.status}","${p.supplier1?.name || ''}","${p.supplier1?.address || ''}","${p.supplier2?.name || ''}","${p.supplier2?.address || ''}","${p.supplier3?.name || ''}","${p.supplier3?.address || ''}","${p.totalAmount}","${itemsJson}","${p.createdAt}"\n`;
+    csvContent += `"${p.id}","${p.prNo}","${p.poNo}","${p.obrNo}","${p.dvNo}","${p.title}","${p.date}","${p.department}","${p.purpose || ''}","${p.status}","${p.supplier1?.name || ''}","${p.supplier1?.address || ''}","${p.supplier2?.name || ''}","${p.supplier2?.address || ''}","${p.supplier3?.name || ''}","${p.supplier3?.address || ''}","${p.totalAmount}","${itemsJson}","${p.createdAt}","${p.priority || 'Normal'}"\n`;
   });
 
   return csvContent;
@@ -112,7 +112,8 @@ export const parseCSV = (text, purchases) => {
         supplier3: { name: values[14], address: values[15] },
         totalAmount: parseFloat(values[16]) || 0,
         items: items,
-        createdAt: values[18] || new Date().toISOString()
+        createdAt: values[18] || new Date().toISOString(),
+        priority: values[19] || 'Normal'
       };
 
       newPurchases.push(purchase);
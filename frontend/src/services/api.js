@@ -54,11 +54,14 @@ export const createPurchase = async (purchaseData) => {
 };
 
 /**
- * Get all purchases
+ * Get a page of purchases
+ * Accepts filters plus limit, cursor (nextCursor of the previous page) and fields.
+ * Resolves to { items, total, hasMore, nextCursor }; total is only counted
+ * for the first page and is null on cursor pages.
  */
-export const getPurchases = async () => {
+export const getPurchases = async (params = {}) => {
   try {
-    const response = await api.get('/api/purchases');
+    const response = await api.get('/api/purchases', { params });
     return { data: response.data, error: null };
   } catch (error) {
     return { 
@@ -113,6 +116,23 @@ export const updatePurchaseStatus = async (id, status) => {
   }
 };
 
+/**
+ * Update the status of many purchases at once
+ * Resolves to { status, updated, results: [{ id, result, previousStatus }] }
+ * where result is updated, unchanged, not_found or conflict.
+ */
+export const updatePurchaseStatusBatch = async (ids, status, { comments = '', approvedBy = '' } = {}) => {
+  try {
+    const response = await api.patch('/api/purchases/status:batch', { ids, status, comments, approvedBy });
+    return { data: response.data, error: null };
+  } catch (error) {
+    return {
+      data: null,
+      error: error.response?.data?.detail || error.message || 'Failed to update statuses'
+    };
+  }
+};
+
 /**
  * Delete a purchase
  */
@@ -143,6 +163,25 @@ export const getDashboardStats = async () => {
   }
 };
 
+/**
+ * Subscribe to live notification and purchase events (Server-Sent Events).
+ * The browser reconnects on its own and resumes from the last event it saw;
+ * onReset means events were missed and data should be refetched.
+ * Returns a function that closes the stream.
+ */
+export const subscribeToEvents = ({ onNotification, onPurchase, onReset } = {}) => {
+  const source = new EventSource(`${API_BASE_URL}/api/stream`);
+  const listen = (type, handler) => {
+    if (handler) {
+      source.addEventListener(type, (event) => handler(JSON.parse(event.data)));
+    }
+  };
+  listen('notification', onNotification);
+  listen('purchase', onPurchase);
+  listen('reset', onReset);
+  return () => source.close();
+};
+
 /**
  * Health check
  */
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+MDRRMO Procurement System list serialization benchmark
+Compares rendering a page of purchases through pydantic models and response_model
+validation (the previous path) against the trusted-read orjson path used by the API.
+
+Usage: python serialization_benchmark.py [--sizes 1000,10000] [--repeat 5] [--json out.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# server.py connects lazily, so placeholder settings are enough to import it
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "mdrrmo_benchmark")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+import server
+
+
+def make_purchase(index):
+    """A purchase shaped like the ones the API stores, with items, suppliers and an attachment"""
+    created = datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=index)
+    items = [
+        {
+            "number": n + 1,
+            "name": f"Item {n + 1}",
+            "description": "Emergency supplies for evacuation center",
+            "unit": "pc",
+            "quantity": 10 + n,
+            "unitPrice": 125.5,
+            "total": (10 + n) * 125.5,
+        }
+        for n in range(5)
+    ]
+    return server.Purchase(
+        prNo=f"2025-PR-{index + 1:03d}",
+        poNo=f"2025-PO-{index + 1:03d}",
+        obrNo=f"2025-OBR-{index + 1:03d}",
+        dvNo=f"2025-DV-{index + 1:03d}",
+        title=f"Procurement of relief goods #{index}",
+        date=created.date().isoformat(),
+        department="MDRRMO",
+        purpose="Disaster preparedness",
+        status="Approved" if index % 3 == 0 else "Pending",
+        supplier1={"name": "ABC Trading", "address": "Poblacion"},
+        supplier2={"name": "XYZ Supply", "address": "Municipal Hall Road"},
+        items=items,
+        totalAmount=sum(item["total"] for item in items),
+        approvalInfo={"approvedBy": "Mayor", "approvedAt": created.isoformat(), "comments": "", "signature": ""},
+        attachments=[{
+            "id": str(uuid.uuid4()),
+            "filename": "blobs/ab/cd/abcd",
+            "originalName": "quotation.pdf",
+            "mimeType": "application/pdf",
+            "size": 48213,
+            "sha256": "ab" * 32,
+        }],
+        createdAt=created.isoformat(),
+    ).model_dump()
+
+
+async def render_validated(docs, field):
+    """Previous path: build every model, then validate and encode against response_model"""
+    page = server.PurchasePage(
+        items=[server.Purchase(**doc).model_dump() for doc in docs],
+        total=len(docs),
+        hasMore=False,
+    )
+    content = await serialize_response(field=field, response_content=page, is_coroutine=True)
+    return JSONResponse(content).body
+
+
+async def render_trusted(docs, field):
+    """Current path: fill defaults and render the documents directly with orjson"""
+    return server.purchase_page_response([server.trusted_purchase(doc) for doc in docs], len(docs), False, None).body
+
+
+async def measure(render, docs, field, repeat):
+    best = None
+    for _ in range(repeat):
+        # Each run gets fresh dicts, as it would from a database cursor
+        batch = [dict(doc) for doc in docs]
+        started = time.perf_counter()
+        body = await render(batch, field)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+async def run(sizes, repeat):
+    field = create_response_field(name="Response_get_purchases", type_=server.PurchasePage)
+    results = []
+    for size in sizes:
+        docs = [make_purchase(i) for i in range(size)]
+        validated, validated_bytes = await measure(render_validated, docs, field, repeat)
+        trusted, trusted_bytes = await measure(render_trusted, docs, field, repeat)
+        results.append({
+            "documents": size,
+            "validatedSeconds": round(validated, 4),
+            "trustedSeconds": round(trusted, 4),
+            "validatedDocsPerSecond": round(size / validated),
+            "trustedDocsPerSecond": round(size / trusted),
+            "speedup": round(validated / trusted, 1),
+            "validatedBytes": validated_bytes,
+            "trustedBytes": trusted_bytes,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000", help="Comma-separated page sizes to render")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement; the fastest is reported")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = asyncio.run(run(sizes, args.repeat))
+
+    print(f"{'docs':>8} {'validated':>12} {'trusted':>12} {'speedup':>8}")
+    for r in results:
+        print(
+            f"{r['documents']:>8} {r['validatedDocsPerSecond']:>10}/s "
+            f"{r['trustedDocsPerSecond']:>10}/s {r['speedup']:>7}x"
+        )
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"benchmark": "list_serialization", "repeat": args.repeat, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Shared fixtures. The app runs in-process against an in-memory mongomock-motor
+database, like api_benchmark.py does without --mongo-url, so no MongoDB is needed.
+"""
+
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+# server.py reads its configuration when it is imported
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "mdrrmo_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+def aware(value: datetime) -> datetime:
+    """mongomock hands datetimes back without a timezone, like MongoDB does; they are UTC"""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def purchase_payload(title="Relief goods", **overrides):
+    payload = {
+        "title": title,
+        "date": "2025-01-20",
+        "department": "MDRRMO",
+        "purpose": "Evacuation center operations",
+        "supplier1": {"name": "ABC Trading", "address": "Pioduran, Albay"},
+        "items": [
+            {"number": 1, "name": "Rice", "unit": "sack", "quantity": 2, "unitPrice": 1250.5, "total": 2501},
+        ],
+        "totalAmount": 2501,
+    }
+    payload.update(overrides)
+    return payload
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def db(monkeypatch, tmp_path):
+    """A fresh database, upload directory and allocator for every test"""
+    client = AsyncMongoMockClient()
+    database = client[os.environ["DB_NAME"]]
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "transactions_enabled", False)
+    monkeypatch.setattr(server, "document_sequences", server.SequenceAllocator(server.SEQUENCE_BLOCK_SIZE))
+
+    monkeypatch.setattr(server, "UPLOADS_DIR", tmp_path)
+    monkeypatch.setattr(server, "INCOMING_DIR", tmp_path / ".incoming")
+    monkeypatch.setattr(server, "BLOBS_DIR", tmp_path / "blobs")
+    server.INCOMING_DIR.mkdir()
+    server.BLOBS_DIR.mkdir()
+
+    server.purchase_read_cache.clear()
+    yield database
+    server.purchase_read_cache.clear()
+
+
+@pytest.fixture
+def memory_sink(monkeypatch):
+    """Deliver outbox notifications only to an in-memory sink"""
+    sink = server.MemorySink()
+    monkeypatch.setattr(server, "notification_sinks", [sink])
+    return sink
+
+
+@pytest.fixture
+async def client():
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        yield http
@@ -0,0 +1,106 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+import server
+from tests.conftest import purchase_payload
+
+pytestmark = pytest.mark.anyio
+
+
+async def import_file(client, name: str, content: str):
+    response = await client.post("/api/purchases/import", files={"file": (name, content.encode("utf-8"))})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def ndjson(*rows) -> str:
+    return "\n".join(json.dumps(row) for row in rows)
+
+
+async def test_csv_export_round_trips_through_import(db, client):
+    created = (await client.post("/api/purchases", json=purchase_payload(priority="High"))).json()
+    await client.patch(f"/api/purchases/{created['id']}/status", json={"status": "For Review"})
+    exported = (await client.get("/api/purchases/export", params={"format": "csv"})).text
+
+    report = await import_file(client, "purchases.csv", exported)
+    assert (report["processed"], report["inserted"], report["updated"], report["failed"]) == (1, 0, 1, 0)
+    assert (await client.get("/api/purchases/export", params={"format": "csv"})).text == exported
+
+    stored = await db.purchases.find_one({"id": created["id"]})
+    assert (stored["priority"], stored["status"], stored["totalCentavos"]) == ("High", "For Review", 250100)
+
+
+async def test_columns_missing_from_the_file_keep_existing_values(db, client):
+    created = (await client.post("/api/purchases", json=purchase_payload(priority="Urgent"))).json()
+    exported = (await client.get("/api/purchases/export", params={"format": "csv"})).text
+    rows = list(csv.DictReader(io.StringIO(exported)))
+    columns = [c for c in server.PURCHASE_CSV_COLUMNS if c not in ("Priority", "Status")]
+    rows.append({**rows[0], "ID": "new-row", "PR_No": "", "PO_No": "", "OBR_No": "", "DV_No": ""})
+
+    out = io.StringIO()
+    writer = csv.DictWriter(out, columns, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+    report = await import_file(client, "partial.csv", out.getvalue())
+    assert (report["inserted"], report["updated"]) == (1, 1)
+
+    existing = await db.purchases.find_one({"id": created["id"]})
+    assert (existing["priority"], existing["status"]) == ("Urgent", "Pending")
+    new = await db.purchases.find_one({"id": "new-row"})
+    assert (new["priority"], new["status"]) == ("Normal", "Pending")
+
+
+async def test_rows_with_non_string_keys_are_reported_and_not_written(db, client):
+    report = await import_file(client, "bad.ndjson", ndjson(
+        {"id": "n1", "prNo": 123, **purchase_payload()},
+        {"id": {"$gt": ""}, **purchase_payload()},
+        {"id": "n3", "dvNo": "", **purchase_payload()},
+        {"id": "ok", **purchase_payload()},
+    ))
+    assert (report["processed"], report["inserted"], report["failed"]) == (4, 1, 3)
+    assert [(e["row"], e["id"], e["errors"]) for e in report["errors"]] == [
+        (1, "n1", ["prNo: must be a non-empty string"]),
+        (2, None, ["id: must be a non-empty string"]),
+        (3, "n3", ["dvNo: must be a non-empty string"]),
+    ]
+    assert await db.purchases.distinct("id") == ["ok"]
+    assert await db.purchase_audit.count_documents({"purchaseId": "ok"}) == 1
+
+
+async def test_invalid_rows_are_reported_per_row(db, client):
+    report = await import_file(client, "mixed.ndjson", "\n".join([
+        json.dumps({"id": "a", **purchase_payload(createdAt="not a date")}),
+        json.dumps({"id": "b", **{k: v for k, v in purchase_payload().items() if k != "title"}}),
+        "{not json",
+        json.dumps(["a", "list"]),
+        json.dumps({"id": "c", **purchase_payload()}),
+    ]))
+    assert (report["processed"], report["inserted"], report["failed"]) == (5, 1, 4)
+    errors = {e["row"]: e["errors"] for e in report["errors"]}
+    assert errors[1][0].startswith("createdAt:")
+    assert errors[2][0].startswith("title:")
+    assert errors[3][0].startswith("Could not parse row")
+    assert errors[4] == ["Each line must be a JSON object"]
+
+
+async def test_imported_numbers_are_not_handed_out_again(db, client):
+    year = datetime.now().year
+    await import_file(client, "numbers.ndjson", ndjson(
+        {"id": "imported", "prNo": f"{year}-PR-050", **purchase_payload()}
+    ))
+    created = (await client.post("/api/purchases", json=purchase_payload())).json()
+    assert created["prNo"] == f"{year}-PR-051"
+
+
+async def test_repeated_id_updates_the_row_imported_before_it(db, client):
+    report = await import_file(client, "repeat.ndjson", ndjson(
+        {"id": "same", **purchase_payload(title="First")},
+        {"id": "same", **purchase_payload(title="Second")},
+    ))
+    assert (report["inserted"], report["updated"]) == (1, 1)
+    assert (await db.purchases.find_one({"id": "same"}))["title"] == "Second"
+    assert await db.purchase_audit.count_documents({"purchaseId": "same"}) == 2
@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from tests.conftest import aware, purchase_payload
+
+pytestmark = pytest.mark.anyio
+
+
+def legacy_notification(index: int, read: bool) -> dict:
+    created = datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=index)
+    return {
+        "id": f"n{index}", "type": "status_changed", "title": "Status Updated", "message": f"#{index}",
+        "purchaseId": None, "read": read, "createdAt": created.isoformat(),
+    }
+
+
+async def test_notification_migration_folds_read_flags_into_a_watermark(db, client):
+    flags = [True, True, False, True, True]
+    await db.notifications.insert_many([legacy_notification(i, read) for i, read in enumerate(flags)])
+
+    report = (await client.post("/api/admin/migrations/notifications")).json()
+    assert (report["sequenced"], report["readFlags"], report["expiries"]) == (5, 4, 5)
+
+    stored = await db.notifications.find({}, {"_id": 0}).sort("seq", 1).to_list(None)
+    assert [n["id"] for n in stored] == ["n0", "n1", "n2", "n3", "n4"]
+    assert all("read" not in n for n in stored)
+    assert aware(stored[0]["expiresAt"]) == datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(days=server.NOTIFICATION_RETENTION_DAYS)
+
+    # The leading run becomes the watermark; only reads after the gap are listed
+    state = await db.notification_reads.find_one({"_id": server.DEFAULT_READ_STATE_ID})
+    assert state["readThrough"] == stored[1]["seq"]
+    assert [entry["id"] for entry in state["readIds"]] == ["n3", "n4"]
+
+    assert (await client.get("/api/notifications/unread-count", params={"user": "ana"})).json() == {"unread": 1}
+    again = await server.migrate_legacy_notifications()
+    assert again == {"sequenced": 0, "readFlags": 0, "expiries": 0}
+
+
+async def test_amount_migration_keeps_totals_the_items_disagree_with(db, monkeypatch):
+    rebuilt = []
+
+    async def record_rebuild():
+        # The dashboard aggregation uses operators mongomock doesn't implement
+        rebuilt.append(True)
+
+    monkeypatch.setattr(server, "rebuild_dashboard_stats", record_rebuild)
+    items = [{"number": 1, "name": "Rice", "unit": "sack", "quantity": 3, "unitPrice": 0.1, "total": 999}]
+    await db.purchases.insert_many([
+        {"id": "matches", "items": items, "totalAmount": 0.3},
+        {"id": "differs", "items": items, "totalAmount": 12.5},
+    ])
+
+    assert await server.migrate_purchase_amounts() == {"purchases": 2, "totalsChanged": 1}
+    matches = await db.purchases.find_one({"id": "matches"})
+    differs = await db.purchases.find_one({"id": "differs"})
+    assert (matches["totalCentavos"], "legacyTotalAmount" in matches) == (30, False)
+    assert (differs["totalCentavos"], differs["totalAmount"], differs["legacyTotalAmount"]) == (30, 0.3, 12.5)
+    assert differs["items"][0]["total"] == 0.3
+
+    audit = await db.purchase_audit.find({}, {"_id": 0}).to_list(None)
+    assert [(a["purchaseId"], a["previousValue"], a["newValue"]) for a in audit] == [("differs", "12.5", "0.3")]
+    assert rebuilt == [True]
+
+    assert await server.migrate_purchase_amounts() == {"purchases": 0, "totalsChanged": 0}
+    assert rebuilt == [True]
+
+
+async def test_date_migration_converts_strings_and_keeps_unparsable_dates(db):
+    await db.purchases.insert_many([
+        {"id": "a", "date": "2025-03-04", "createdAt": "2025-03-04T08:30:00Z"},
+        {"id": "b", "date": "sometime in March", "createdAt": "2025-03-05T00:00:00+08:00"},
+    ])
+    await db.purchase_audit.insert_one({"id": "e1", "purchaseId": "a", "timestamp": "2025-03-04T08:30:00+00:00"})
+
+    report = await server.migrate_string_dates()
+    assert report == {"purchases": 2, "auditEntries": 1, "unparsedDates": 1}
+
+    a = await db.purchases.find_one({"id": "a"})
+    b = await db.purchases.find_one({"id": "b"})
+    assert aware(a["date"]) == datetime(2025, 3, 4, tzinfo=timezone.utc)
+    assert aware(a["createdAt"]) == datetime(2025, 3, 4, 8, 30, tzinfo=timezone.utc)
+    assert (b["date"], b["unparsedDate"]) == (None, "sometime in March")
+    assert aware(b["createdAt"]) == datetime(2025, 3, 4, 16, tzinfo=timezone.utc)
+    assert isinstance((await db.purchase_audit.find_one({"id": "e1"}))["timestamp"], datetime)
+
+    assert (await server.migrate_string_dates())["purchases"] == 0
+
+
+async def test_embedded_audit_trails_move_to_their_own_collection(db, client):
+    await db.purchases.insert_one({
+        **purchase_payload(), "id": "legacy", "prNo": "2024-PR-001", "status": "Pending",
+        "createdAt": datetime(2024, 5, 1, tzinfo=timezone.utc),
+        "auditTrail": [
+            {"timestamp": "2024-05-01T00:00:00+00:00", "action": "created", "user": "ana", "details": "Created"},
+            {"timestamp": "2024-05-02T00:00:00+00:00", "action": "approved", "user": "ben", "details": "Approved"},
+        ],
+    })
+
+    assert await server.migrate_embedded_audit_trails() == {"purchases": 1, "entries": 2}
+    assert "auditTrail" not in await db.purchases.find_one({"id": "legacy"})
+    history = (await client.get("/api/purchases/legacy/history")).json()
+    assert [entry["action"] for entry in history["history"]] == ["created", "approved"]
+
+    assert await server.migrate_embedded_audit_trails() == {"purchases": 0, "entries": 0}
+    assert await db.purchase_audit.count_documents({"purchaseId": "legacy"}) == 2
+
+
+async def test_startup_runs_the_notification_migration(db):
+    await db.notifications.insert_one(legacy_notification(0, read=True))
+    await server.startup_notification_migration()
+    assert "read" not in await db.notifications.find_one({"id": "n0"})
+    assert (await db.notification_reads.find_one({"_id": server.DEFAULT_READ_STATE_ID}))["readThrough"] == 1
@@ -0,0 +1,174 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from tests.conftest import aware
+
+pytestmark = pytest.mark.anyio
+
+
+class FlakySink(server.NotificationSink):
+    """Fails the first `failures` deliveries, then behaves like MemorySink"""
+    name = "flaky"
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.delivered = []
+
+    async def deliver(self, notifications):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("sink unavailable")
+        self.delivered.extend(notifications)
+
+
+def notification(title="Status Updated", message="PR 1 moved to Approved", purchase_id="p1"):
+    return server.new_notification("status_changed", title, message, purchase_id)
+
+
+async def make_due(db):
+    await db.notification_outbox.update_many({}, {"$set": {"nextAttemptAt": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+
+
+async def test_drain_delivers_each_entry_once(db, memory_sink):
+    first, second = notification(title="A"), notification(title="B")
+    await server.enqueue_notifications([first, second])
+
+    assert await server.drain_outbox_once() == 2
+    assert sorted(n["id"] for n in memory_sink.delivered) == sorted([first["id"], second["id"]])
+    entries = await db.notification_outbox.find({}, {"_id": 0}).to_list(None)
+    assert {e["status"] for e in entries} == {"delivered"}
+    assert all(e["delivered"] == ["memory"] and "lease" not in e for e in entries)
+
+    assert await server.drain_outbox_once() == 0
+    assert len(memory_sink.delivered) == 2
+
+
+async def test_identical_pending_notifications_are_deduplicated(db, memory_sink):
+    await server.enqueue_notification(notification())
+    await server.enqueue_notification(notification())
+    assert await db.notification_outbox.count_documents({}) == 1
+
+    await server.drain_outbox_once()
+    assert len(memory_sink.delivered) == 1
+
+    # Once delivered, the same content is a new event again
+    await server.enqueue_notification(notification())
+    await server.drain_outbox_once()
+    assert len(memory_sink.delivered) == 2
+
+
+async def test_racing_duplicates_are_delivered_once(db, memory_sink):
+    # Two enqueues that both missed each other's upsert
+    now = datetime.now(timezone.utc)
+    for n in (notification(), notification()):
+        await db.notification_outbox.insert_one({
+            "id": n["id"], "dedupeKey": server.notification_dedupe_key(n), "status": "pending",
+            "notification": n, "attempts": 0, "delivered": [], "nextAttemptAt": now, "createdAt": now,
+        })
+
+    assert await server.drain_outbox_once() == 2
+    assert len(memory_sink.delivered) == 1
+    statuses = sorted(e["status"] for e in await db.notification_outbox.find({}).to_list(None))
+    assert statuses == ["delivered", "duplicate"]
+
+
+async def test_failed_delivery_is_retried_after_backoff(db, monkeypatch):
+    sink = FlakySink(failures=1)
+    monkeypatch.setattr(server, "notification_sinks", [sink])
+    await server.enqueue_notification(notification())
+
+    await server.drain_outbox_once()
+    entry = await db.notification_outbox.find_one({})
+    assert entry["status"] == "pending"
+    assert entry["attempts"] == 1
+    assert entry["lastError"] == "flaky: sink unavailable"
+    assert aware(entry["nextAttemptAt"]) > datetime.now(timezone.utc)
+
+    # Not due yet
+    assert await server.drain_outbox_once() == 0
+    assert sink.delivered == []
+
+    await make_due(db)
+    assert await server.drain_outbox_once() == 1
+    assert len(sink.delivered) == 1
+    assert (await db.notification_outbox.find_one({}))["status"] == "delivered"
+
+
+async def test_retry_skips_sinks_that_already_succeeded(db, monkeypatch):
+    memory, flaky = server.MemorySink(), FlakySink(failures=1)
+    monkeypatch.setattr(server, "notification_sinks", [memory, flaky])
+    await server.enqueue_notification(notification())
+
+    await server.drain_outbox_once()
+    assert (await db.notification_outbox.find_one({}))["delivered"] == ["memory"]
+
+    await make_due(db)
+    await server.drain_outbox_once()
+    assert len(memory.delivered) == 1
+    assert len(flaky.delivered) == 1
+    assert (await db.notification_outbox.find_one({}))["delivered"] == ["flaky", "memory"]
+
+
+async def test_entry_fails_after_max_attempts(db, monkeypatch):
+    monkeypatch.setattr(server, "notification_sinks", [FlakySink(failures=10)])
+    monkeypatch.setattr(server, "OUTBOX_MAX_ATTEMPTS", 2)
+    await server.enqueue_notification(notification())
+
+    await server.drain_outbox_once()
+    await make_due(db)
+    await server.drain_outbox_once()
+    entry = await db.notification_outbox.find_one({})
+    assert entry["status"] == "failed"
+    assert entry["attempts"] == 2
+
+    await make_due(db)
+    assert await server.drain_outbox_once() == 0
+
+
+def test_backoff_grows_and_is_capped():
+    first = server.outbox_backoff(1).total_seconds()
+    third = server.outbox_backoff(3).total_seconds()
+    assert server.OUTBOX_BACKOFF_SECONDS / 2 <= first <= server.OUTBOX_BACKOFF_SECONDS
+    assert server.OUTBOX_BACKOFF_SECONDS * 2 <= third <= server.OUTBOX_BACKOFF_SECONDS * 4
+    assert server.outbox_backoff(50).total_seconds() <= server.OUTBOX_MAX_BACKOFF_SECONDS
+
+
+async def test_entries_leased_by_another_worker_wait_for_the_lease_to_expire(db, memory_sink):
+    await server.enqueue_notification(notification())
+    await db.notification_outbox.update_many({}, {"$set": {
+        "lease": "other-worker",
+        "leaseUntil": datetime.now(timezone.utc) + timedelta(seconds=server.OUTBOX_LEASE_SECONDS),
+    }})
+    assert await server.drain_outbox_once() == 0
+    assert memory_sink.delivered == []
+
+    # The other worker died; its lease runs out and the entry is claimed again
+    await db.notification_outbox.update_many({}, {"$set": {"leaseUntil": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+    assert await server.drain_outbox_once() == 1
+    assert len(memory_sink.delivered) == 1
+
+
+async def test_inbox_redelivery_keeps_one_copy(db):
+    inbox = server.InboxSink()
+    first, second = notification(title="A"), notification(title="B")
+    await inbox.deliver([first])
+    await inbox.deliver([first, second])
+
+    stored = await db.notifications.find({}, {"_id": 0, "id": 1, "seq": 1}).sort("seq", 1).to_list(None)
+    assert [n["id"] for n in stored] == [first["id"], second["id"]]
+    assert stored[0]["seq"] < stored[1]["seq"]
+
+
+async def test_notification_delivered_after_mark_all_read_stays_unread(db, client):
+    inbox = server.InboxSink()
+    queued_first, queued_later = notification(title="Retried"), notification(title="On time")
+    await inbox.deliver([queued_later])
+    await client.patch("/api/notifications/mark-all-read")
+
+    # The retried entry was created earlier but only arrives now
+    await inbox.deliver([queued_first])
+    assert (await client.get("/api/notifications/unread-count")).json() == {"unread": 1}
+    items = (await client.get("/api/notifications", params={"unread_only": True})).json()["items"]
+    assert [n["id"] for n in items] == [queued_first["id"]]
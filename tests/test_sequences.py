@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_each_prefix_and_year_is_its_own_series(db):
+    allocator = server.SequenceAllocator()
+    assert [await allocator.next("PR", 2025) for _ in range(3)] == [1, 2, 3]
+    assert await allocator.next("PO", 2025) == 1
+    assert await allocator.next("PR", 2026) == 1
+
+
+async def test_series_starts_after_numbers_issued_before_counters(db):
+    await db.purchases.insert_many([
+        {"id": "a", "prNo": "2025-PR-007"},
+        {"id": "b", "prNo": "2025-PR-012"},
+        {"id": "c", "prNo": "2024-PR-099"},
+    ])
+    assert await server.SequenceAllocator().next("PR", 2025) == 13
+
+
+async def test_concurrent_allocations_are_unique(db):
+    allocator = server.SequenceAllocator()
+    numbers = await asyncio.gather(*(allocator.next("PR", 2025) for _ in range(20)))
+    assert sorted(numbers) == list(range(1, 21))
+
+
+async def test_workers_with_blocks_never_hand_out_the_same_number(db):
+    workers = [server.SequenceAllocator(block_size=5), server.SequenceAllocator(block_size=5)]
+    numbers = [await workers[i % 2].next("PR", 2025) for i in range(12)]
+    assert len(set(numbers)) == 12
+    # Each worker draws from its own reserved block
+    assert numbers[:4] == [1, 6, 2, 7]
+
+
+async def test_reserve_many_claims_a_consecutive_range(db):
+    allocator = server.SequenceAllocator()
+    assert await allocator.next("DV", 2025) == 1
+    assert await allocator.reserve_many("DV", 2025, 10) == 2
+    assert await allocator.next("DV", 2025) == 12
+
+
+async def test_advance_past_skips_numbers_issued_elsewhere(db):
+    allocator = server.SequenceAllocator()
+    await allocator.advance_past("PR", 2025, 40)
+    assert await allocator.next("PR", 2025) == 41
+    # Never moves backwards
+    await allocator.advance_past("PR", 2025, 5)
+    assert await allocator.next("PR", 2025) == 42
+
+
+async def test_advance_past_trims_the_reserved_block(db):
+    allocator = server.SequenceAllocator(block_size=10)
+    assert await allocator.next("PR", 2025) == 1
+    # 2..10 are reserved by this worker; an import used 4
+    await allocator.advance_past("PR", 2025, 4)
+    assert await allocator.next("PR", 2025) == 5
+    await allocator.advance_past("PR", 2025, 30)
+    assert await allocator.next("PR", 2025) == 31